@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+import os
+import os.path
+import sys
+import time
+import optparse
+import subprocess
+import wsgiref.util
+try:
+    import cStringIO as StringIO
+except ImportError:
+    import StringIO
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVERS = {"source": "Development/1.0",
+           "compiled": "Google App Engine/1.3.8"}
+USAGE = """%prog [options]
+
+Measures cold starts of Pastedown: the time from importing pastedown.app to
+the first rendered response, each in a new process. Templates are loaded
+from source as on the development server, and precompiled as in
+production if pastedown/views_compiled exists. Run
+`python setup.py compile_templates` first to compare both."""
+
+
+def setup_environment(sdk, server):
+    """Sets up the App Engine SDK and in-memory API stubs."""
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, ROOT)
+    os.environ.update(APPLICATION_ID="pastedown",
+                      AUTH_DOMAIN="gmail.com",
+                      CURRENT_VERSION_ID="benchmark.1",
+                      SERVER_SOFTWARE=server)
+    from google.appengine.api import apiproxy_stub_map, datastore_file_stub, \
+                                     urlfetch_stub, user_service_stub
+    from google.appengine.api.memcache import memcache_stub
+    try:
+        from google.appengine.api.taskqueue import taskqueue_stub
+    except ImportError:
+        from google.appengine.api.labs.taskqueue import taskqueue_stub
+    apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+    stubs = [
+        ("datastore_v3",
+         datastore_file_stub.DatastoreFileStub("pastedown", None, None)),
+        ("memcache", memcache_stub.MemcacheServiceStub()),
+        ("taskqueue", taskqueue_stub.TaskQueueServiceStub(root_path=ROOT)),
+        ("urlfetch", urlfetch_stub.URLFetchServiceStub()),
+        ("user", user_service_stub.UserServiceStub())
+    ]
+    for name, stub in stubs:
+        apiproxy_stub_map.apiproxy.RegisterStub(name, stub)
+
+
+def cold_start(path):
+    """Imports the application and requests the path. Returns seconds
+    taken to import and seconds taken until the first response.
+
+    """
+    start = time.time()
+    import pastedown.app
+    imported = time.time()
+    environ = {"REQUEST_METHOD": "GET", "PATH_INFO": path,
+               "HTTP_ACCEPT": "text/html", "CONTENT_TYPE": "",
+               "wsgi.input": StringIO.StringIO()}
+    wsgiref.util.setup_testing_defaults(environ)
+    status = []
+    def start_response(code, headers, exc_info=None):
+        status.append(code)
+    body = "".join(pastedown.app.application(environ, start_response))
+    if not status[0].startswith("200") or not body:
+        raise RuntimeError("%s responded %s" % (path, status[0]))
+    return imported - start, time.time() - start
+
+
+def run(mode, options):
+    """Runs cold starts in new processes. Returns lists of import times
+    and first response times.
+
+    """
+    imports = []
+    responses = []
+    for i in xrange(options.number):
+        child = subprocess.Popen(
+            [sys.executable, __file__, "--child", mode,
+             "--sdk", options.sdk, "--path", options.path],
+            stdout=subprocess.PIPE
+        )
+        output = child.communicate()[0]
+        if child.returncode:
+            raise RuntimeError("%s cold start failed" % mode)
+        imported, responded = map(float, output.split())
+        imports.append(imported)
+        responses.append(responded)
+    return imports, responses
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    parser = optparse.OptionParser(usage=USAGE)
+    parser.add_option("-s", "--sdk",
+                      default=os.environ.get("GAE_SDK",
+                                             "/usr/local/google_appengine"),
+                      help="path to the App Engine SDK [%default]")
+    parser.add_option("-n", "--number", type="int", default=10,
+                      help="cold starts for each mode [%default]")
+    parser.add_option("-p", "--path", default="/",
+                      help="path to request [%default]")
+    parser.add_option("--child", choices=SERVERS.keys(), help="internal")
+    options, args = parser.parse_args()
+    if options.child:
+        setup_environment(options.sdk, SERVERS[options.child])
+        print "%f %f" % cold_start(options.path)
+        return
+    modes = ["source"]
+    if os.path.isdir(os.path.join(ROOT, "pastedown", "views_compiled")):
+        modes.append("compiled")
+    print "%-10s %12s %20s" % ("templates", "import (ms)",
+                               "first response (ms)")
+    for mode in modes:
+        imports, responses = run(mode, options)
+        print "%-10s %12.1f %20.1f" % (mode, median(imports) * 1000,
+                                       median(responses) * 1000)
+
+
+if __name__ == "__main__":
+    main()
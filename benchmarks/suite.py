@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+import random
+import marshal
+import traceback
+import optparse
+import wsgiref.util
+try:
+    import cStringIO as StringIO
+except ImportError:
+    import StringIO
+import startup
+
+
+USAGE = """%prog [options] [SCENARIO...]
+
+Benchmarks the core request paths of Pastedown against the in-memory App
+Engine stubs and a fake VLAAH session. It seeds documents, a deep fork
+chain, a long history and a large body, and then runs each scenario,
+reporting latency, datastore and memcache RPCs, VLAAH lookups and the
+memory it grew by as JSON. Each scenario runs in a child process forked
+from the seeded one. All scenarios run unless some are named."""
+WORDS = ("markdown pastebin document revision fork history title body "
+         "lorem ipsum dolor sit amet consectetur adipiscing elit sed do "
+         "eiusmod tempor incididunt ut labore et dolore magna aliqua").split()
+
+
+class RPCCounter(object):
+    """Counts API calls by service through an apiproxy hook."""
+
+    def __init__(self):
+        self.counts = {}
+
+    def __call__(self, service, call, *args):
+        self.counts[service] = self.counts.get(service, 0) + 1
+
+    def reset(self):
+        self.counts.clear()
+
+
+def install_fake_vlaah():
+    """Injects a VLAAH session that makes people up instead of calling the
+    API. It must run before pastedown.model is imported. Returns the
+    session.
+
+    """
+    import vlaah
+    import pastedown
+
+    class FakePerson(vlaah.Person):
+
+        def __init__(self, name):
+            self._name = name
+
+        name = property(lambda self: self._name)
+        normal_name = property(lambda self: self._name.lower())
+        nick = property(lambda self: self._name.lstrip("~"))
+        picture_url = property(lambda self: "/etc/images/vlaah.png")
+
+    class FakeSession(vlaah.Session):
+
+        appkey = "benchmark"
+
+        def __init__(self):
+            self.calls = 0
+
+        def find(self, name):
+            self.calls += 1
+            if name and name.startswith("~"):
+                return FakePerson(name)
+
+    pastedown.VLAAH = FakeSession()
+    return pastedown.VLAAH
+
+
+def make_body(rng, size):
+    """Makes a Markdown body of about the size in bytes."""
+    parts = ["# " + " ".join(rng.sample(WORDS, 4)).capitalize()]
+    length = len(parts[0])
+    while length < size:
+        words = " ".join(rng.choice(WORDS) for i in xrange(60))
+        kind = rng.randrange(6)
+        if kind == 0:
+            part = "## " + words[:40]
+        elif kind == 1:
+            part = "\n".join("- " + words[i:i + 30] for i in (0, 30, 60))
+        elif kind == 2:
+            part = "    " + words.replace(" ", "\n    ", 4)
+        else:
+            part = words.capitalize() + "."
+        parts.append(part)
+        length += len(part) + 2
+    return u"\n\n".join(parts)
+
+
+def seed(options):
+    """Seeds the datastore. Returns a dict of the seeded entities that
+    scenarios use.
+
+    """
+    from pastedown.model import Document, find_person
+    rng = random.Random(options.seed)
+    people = [find_person("~bench%d" % i) for i in xrange(10)]
+    for i in xrange(options.documents):
+        author = rng.choice(people + [None])
+        Document(author=author, body=make_body(rng, 1024)).put()
+    chain = Document(author=people[0], body=make_body(rng, 4096))
+    chain.put()
+    for i in xrange(options.fork_depth):
+        chain = chain.fork(rng.choice(people), make_body(rng, 4096))
+        chain.put()
+    history = Document(author=people[1], body=make_body(rng, 4096))
+    history.put()
+    body = history.body
+    for i in xrange(options.history):
+        body += u"\n\n" + make_body(rng, 80)
+        history.body = body
+    large = Document(author=people[2],
+                     body=make_body(rng, options.body_size * 1024))
+    large.put()
+    for i in xrange(options.collisions):
+        body = u"Collision\n\n" + make_body(rng, 80)
+        Document(author=people[3], body=body).put()
+    return {"person": people[3], "chain": chain, "history": history,
+            "large": large}
+
+
+def request(path, accept="text/html"):
+    """Requests the path from the application. Returns the body."""
+    import pastedown.app
+    environ = {"REQUEST_METHOD": "GET", "PATH_INFO": path,
+               "HTTP_ACCEPT": accept, "CONTENT_TYPE": "",
+               "wsgi.input": StringIO.StringIO()}
+    wsgiref.util.setup_testing_defaults(environ)
+    status = []
+    def start_response(code, headers, exc_info=None):
+        status.append(code)
+    body = "".join(pastedown.app.application(environ, start_response))
+    if not status[0].startswith("200"):
+        raise RuntimeError("%s responded %s" % (path, status[0]))
+    return body
+
+
+def create_scenarios(seeded):
+    """Returns a dict of scenario functions by their names."""
+    from pastedown.model import Document, create_title, MARKDOWN
+    url = lambda document: "/" + document.key().name() + "/"
+    large_html = MARKDOWN.convert(seeded["large"].body)
+    def page_history():
+        revisions = Document.get(seeded["history"].key()).revisions
+        page, token = revisions.page(20)
+        while token:
+            page, token = revisions.page(20, token)
+    def collide():
+        def id(name):
+            return "collision-" + name if name else "collision"
+        Document.create_key_name(seeded["person"], id)
+    return {
+        "home": lambda: request("/"),
+        "document_html": lambda: request(url(seeded["large"])),
+        "document_raw": lambda: request(url(seeded["large"]),
+                                        "text/x-markdown"),
+        "fork_chain_html": lambda: request(url(seeded["chain"])),
+        "history_pages": page_history,
+        "create_key_name_collisions": collide,
+        "create_title_large": lambda: create_title(large_html),
+    }
+
+
+def run(function, runs, counter, vlaah, cold):
+    """Runs the function and returns its statistics."""
+    from google.appengine.api import memcache
+    import pastedown.model
+    times = []
+    rpcs = {}
+    lookups = []
+    for i in xrange(runs):
+        if cold:
+            memcache.flush_all()
+            for cache in (pastedown.model.HTML_CACHE,
+                          pastedown.model.BLOCK_CACHE,
+                          pastedown.model.BODY_CACHE):
+                cache.local.clear()
+            pastedown.model.PEOPLE.clear()
+        counter.reset()
+        calls = vlaah.calls
+        start = time.time()
+        function()
+        times.append((time.time() - start) * 1000)
+        for service, count in counter.counts.iteritems():
+            rpcs.setdefault(service, []).append(count)
+        lookups.append(vlaah.calls - calls)
+    return {
+        "runs": runs,
+        "median_ms": startup.median(times),
+        "min_ms": min(times),
+        "max_ms": max(times),
+        "rpcs": dict((service, startup.median(counts))
+                     for service, counts in rpcs.iteritems()),
+        "vlaah_calls": startup.median(lookups)
+    }
+
+
+def read_memory():
+    """Returns the resident set size and its peak of the process in KB, as
+    VmRSS and VmHWM in /proc/self/status.
+
+    """
+    sizes = {}
+    status = open("/proc/self/status")
+    try:
+        for line in status:
+            name, _, value = line.partition(":")
+            if name in ("VmRSS", "VmHWM"):
+                sizes[name] = int(value.split()[0])
+    finally:
+        status.close()
+    return sizes["VmRSS"], sizes["VmHWM"]
+
+
+def reset_peak_memory():
+    """Resets the peak resident set size of the process to the current one.
+    A forked child inherits the peak of its parent, which would hide its own
+    growth. Returns False when the kernel cannot, e.g. on other than Linux.
+
+    """
+    try:
+        clear_refs = open("/proc/self/clear_refs", "w")
+        try:
+            clear_refs.write("5")
+        finally:
+            clear_refs.close()
+    except IOError:
+        return False
+    return True
+
+
+def run_forked(function, runs, counter, vlaah, cold):
+    """Runs the function by run() in a child process forked from the seeded
+    one, so that scenarios do not share caches and each reports how much
+    its peak memory grew over the seeded state. The growth is None where
+    the peak cannot be reset.
+
+    """
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        try:
+            measured = reset_peak_memory()
+            if measured:
+                start = read_memory()[0]
+            stats = run(function, runs, counter, vlaah, cold)
+            stats["rss_growth_kb"] = None
+            if measured:
+                stats["rss_growth_kb"] = read_memory()[1] - start
+            output = os.fdopen(write, "wb")
+            output.write(marshal.dumps(stats))
+            output.close()
+        except:
+            traceback.print_exc()
+            os._exit(1)
+        os._exit(0)
+    os.close(write)
+    input = os.fdopen(read, "rb")
+    try:
+        output = input.read()
+    finally:
+        input.close()
+    if os.waitpid(pid, 0)[1]:
+        raise RuntimeError("scenario failed")
+    return marshal.loads(output)
+
+
+def main():
+    parser = optparse.OptionParser(usage=USAGE)
+    parser.add_option("-s", "--sdk",
+                      default=os.environ.get("GAE_SDK",
+                                             "/usr/local/google_appengine"),
+                      help="path to the App Engine SDK [%default]")
+    parser.add_option("-n", "--runs", type="int", default=10,
+                      help="runs of each scenario [%default]")
+    parser.add_option("--cold", action="store_true", default=False,
+                      help="flush caches before each run")
+    parser.add_option("--documents", type="int", default=200,
+                      help="documents to seed [%default]")
+    parser.add_option("--fork-depth", type="int", default=20,
+                      help="length of the fork chain [%default]")
+    parser.add_option("--history", type="int", default=100,
+                      help="revisions of the long history [%default]")
+    parser.add_option("--body-size", type="int", default=200,
+                      help="size of the large body in KB [%default]")
+    parser.add_option("--collisions", type="int", default=50,
+                      help="documents of the same title [%default]")
+    parser.add_option("--seed", type="int", default=0,
+                      help="random seed [%default]")
+    parser.add_option("-o", "--output", help="file to write JSON to")
+    options, names = parser.parse_args()
+    startup.setup_environment(options.sdk, startup.SERVERS["compiled"])
+    try:
+        import json
+    except ImportError:
+        from django.utils import simplejson as json
+    from google.appengine.api import apiproxy_stub_map
+    counter = RPCCounter()
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append("benchmark", counter)
+    vlaah = install_fake_vlaah()
+    start = time.time()
+    scenarios = create_scenarios(seed(options))
+    seeding = time.time() - start
+    for name in names:
+        if name not in scenarios:
+            parser.error("no such scenario: " + name)
+    results = {}
+    for name in sorted(names or scenarios):
+        results[name] = run_forked(scenarios[name], options.runs, counter,
+                                   vlaah, options.cold)
+    report = {"options": options.__dict__, "seeding_s": seeding,
+              "scenarios": results}
+    output = options.output and open(options.output, "w") or sys.stdout
+    try:
+        json.dump(report, output, indent=2, sort_keys=True)
+        output.write("\n")
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
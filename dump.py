@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+import os
+import os.path
+import sys
+import gzip
+import getpass
+import optparse
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+USAGE = """%prog [options] export|import FILE
+
+Exports every document and revision of a Pastedown application to FILE as
+gzipped JSON Lines, or imports them from FILE. It connects to the
+application through remote_api, which is mapped to /remote_api for
+administrators. Revisions are imported with key names made of their old ids,
+e.g. id123, so every fork reference keeps pointing to the same revision."""
+
+
+def connect(options):
+    """Sets up the App Engine SDK and the remote API."""
+    sys.path.insert(0, options.sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, ROOT)
+    from google.appengine.ext.remote_api import remote_api_stub
+    def authenticate():
+        email = options.email or raw_input("Email: ")
+        return email, getpass.getpass("Password: ")
+    remote_api_stub.ConfigureRemoteApi(options.application, "/remote_api",
+                                       authenticate, options.server)
+
+
+def main():
+    parser = optparse.OptionParser(usage=USAGE)
+    parser.add_option("-s", "--sdk",
+                      default=os.environ.get("GAE_SDK",
+                                             "/usr/local/google_appengine"),
+                      help="path to the App Engine SDK [%default]")
+    parser.add_option("-a", "--application", default="pastedown",
+                      help="application id [%default]")
+    parser.add_option("-H", "--server", default="localhost:8080",
+                      help="host of the application [%default]")
+    parser.add_option("-e", "--email", help="administrator email")
+    options, args = parser.parse_args()
+    if len(args) != 2 or args[0] not in ("export", "import"):
+        parser.error("expected export or import, and a file")
+    command, filename = args
+    connect(options)
+    import pastedown.dump
+    if command == "export":
+        file = gzip.open(filename, "wb")
+        try:
+            pastedown.dump.export_entities(file.write)
+        finally:
+            file.close()
+    else:
+        file = gzip.open(filename, "rb")
+        try:
+            pastedown.dump.import_entities(file)
+        finally:
+            file.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -6,18 +6,35 @@ import vlaah
 CONFIG_FILE = os.path.join(os.path.dirname(__file__), "config.ini")
 
 
-def configuration(section, file=None):
-    """Reads attributes dict of a section from the configuration file."""
+def configuration(section, file=None, optional=False):
+    """Reads attributes dict of a section from the configuration file. An
+    optional section reads as an empty dict when it is missing.
+
+    """
     conf = ConfigParser.ConfigParser()
     file = file or CONFIG_FILE
     conf.read(file)
     try:
         settings = conf.items(section)
     except ConfigParser.NoSectionError:
+        if optional:
+            return {}
         raise IOError("copy %s.dist to %s and set it up" % (file, file))
     return dict(settings)
 
 
+def revision_storage(file=None):
+    """Reads the revision storage settings. Revisions are stored as deltas
+    only when ``deltas`` is on in the optional ``[revisions]`` section, with
+    a full snapshot every ``snapshot_interval`` revisions.
+
+    """
+    config = configuration("revisions", file, optional=True)
+    deltas = config.get("deltas", "off").lower() in ("1", "yes", "true", "on")
+    return {"deltas": deltas,
+            "snapshot_interval": int(config.get("snapshot_interval", 10))}
+
+
 def vlaah_session():
     """Creates a VLAAH session instance."""
     global VLAAH
@@ -1,31 +1,35 @@
+import os
+import time
+import calendar
 import datetime
+import email.utils
 import hashlib
 import urllib
 from google.appengine.ext import webapp, db
 from google.appengine.api import memcache
-import beaker.middleware
 import jinja2
 import vlaah
 from recaptcha.client import captcha
 import pastedown
+import pastedown.fragment
+import pastedown.instrument
+import pastedown.migration
+import pastedown.search
+import pastedown.session
 from pastedown.model import *
 from pastedown.appext import WSGIApplication
 from pastedown.template import ENVIRONMENT as VIEW_ENV
 
 
-BEAKER_SESSION_OPTIONS = {
-    "session.type": "ext:google",
-    "session.auto": True,
-    "session.cookie_expires": True,
-    "session.key": "pastedown_session",
-    "session.secret": VLAAH.appkey
-}
+MAX_BODY_SIZE = int(pastedown.configuration("request", optional=True)
+                       .get("max_body_size", 1024 * 1024))
 
 
-def _session_setter(name, map):
+def _session_setter(name, map, memo):
     def fset(self, value):
+        setattr(self, memo, value)
         if value is None:
-            del self.session[name]
+            self.session.pop(name)
         else:
             self.session[name] = map(value)
     return fset
@@ -39,42 +43,95 @@ def captcha_submit(request):
                           request.remote_addr)
 
 
+def format_http_date(value):
+    """Formats the UTC datetime as an HTTP date."""
+    return email.utils.formatdate(calendar.timegm(value.utctimetuple()),
+                                  usegmt=True)
+
+
+def parse_http_date(value):
+    """Parses the HTTP date into a UTC datetime. Returns None when the value
+    is missing or malformed.
+
+    """
+    parsed = value and email.utils.parsedate_tz(value)
+    if parsed:
+        timestamp = email.utils.mktime_tz(parsed)
+        return datetime.datetime.utcfromtimestamp(timestamp)
+
+
 class BaseHandler(webapp.RequestHandler):
 
     @property
     def session(self):
-        """Beaker session object."""
-        return self.request.environ["beaker.session"]
+        """Session object. It is loaded on the first access and saved only
+        when it changes.
+
+        """
+        return self.request.environ["pastedown.session"]
 
     def person(self):
-        """Signed person."""
-        if "person_name" in self.session and self.session["person_name"]:
-            topic = VLAAH.find(self.session["person_name"])
-            if isinstance(topic, vlaah.Person):
-                return topic
+        """Signed person. It is resolved once per request. A session signed
+        in before the person signed out somewhere is of an older epoch, and
+        is signed out.
+
+        """
+        try:
+            return self._person
+        except AttributeError:
+            name = self.session.get("person_name")
+            if name and self.session.get("epoch") != find_session_epoch(name):
+                for key in "person_name", "ticket_id", "epoch":
+                    self.session.pop(key)
+                name = None
+            self._person = name and find_person(name) or None
+            return self._person
 
     person = property(
         fget=person,
-        fset=_session_setter("person_name", lambda person: person.name)
+        fset=_session_setter("person_name", lambda person: person.name,
+                             "_person")
     )
 
     def ticket(self):
-        """Allowed ticket."""
-        if "ticket_id" in self.session and self.person:
-            ticket_id = self.session["ticket_id"]
-            if ticket_id:
-                try:
-                    return self.person.tickets[ticket_id]
-                except KeyError:
-                    del self.session["ticket_id"]
-                    return
+        """Allowed ticket. It is resolved once per request."""
+        try:
+            return self._ticket
+        except AttributeError:
+            self._ticket = None
+        ticket_id = self.session.get("ticket_id")
+        if ticket_id and self.person:
+            try:
+                self._ticket = find_ticket(self.person, ticket_id)
+            except KeyError:
+                del self.session["ticket_id"]
+        return self._ticket
 
     ticket = property(
         fget=ticket,
-        fset=_session_setter("ticket_id", lambda ticket: ticket.id)
+        fset=_session_setter("ticket_id", lambda ticket: ticket.id, "_ticket")
     )
 
+    def find_document(self, person, id):
+        """Finds the document. Responds as 404 when the document is not
+        found or its key_name is just claimed and nothing is written yet.
+
+        """
+        if person:
+            person = find_person("~" + person)
+            if not person:
+                self.error(404)
+                return
+        else:
+            person = None
+        document = Document.find(person, id)
+        if not document or document.updated_at is None:
+            self.error(404)
+            return
+        return document
+
     def render(self, template, **kwargs):
+        start = time.time()
         t = VIEW_ENV.get_template(template)
         view = t.generate(handler=self,
                           person=self.person,
@@ -82,16 +139,13 @@ class BaseHandler(webapp.RequestHandler):
                           **kwargs)
         for part in view:
             self.response.out.write(part)
+        pastedown.instrument.record("render", time.time() - start)
 
 
 class HomeHandler(BaseHandler):
 
-    NUMBER_TO_FETCH = 10
-
     def get(self, body=None, captcha_response=None):
-        docs = Document.all().filter("updated_at != ", None) \
-                             .order("-updated_at") \
-                             .fetch(self.NUMBER_TO_FETCH)
+        docs = RecentDocuments.get_entries()
         self.render("home.html", documents=docs,
                                  body=body,
                                  captcha_response=captcha_response)
@@ -117,10 +171,11 @@ class LoginHandler(BaseHandler):
         name = self.request.get("person")
         key = self.request.get("key")
         back = self.request.get("destination")
-        person = VLAAH.find(name)
+        person = find_person(name)
         ticket = person.tickets[memcache.get(key, self.MEMCACHE_NAMESPACE)]
         self.ticket = ticket
         self.person = person
+        self.session["epoch"] = find_session_epoch(person.name)
         self.redirect(back)
 
     def post(self):
@@ -132,7 +187,7 @@ class LoginHandler(BaseHandler):
             person = hasattr(topic, "person") and topic.person
         else:
             name = name if name[0] == "~" else "~" + name
-            person = VLAAH.find(name)
+            person = find_person(name)
         if isinstance(person, vlaah.Person):
             ip = self.request.remote_addr
             while True:
@@ -153,20 +208,59 @@ class LoginHandler(BaseHandler):
 
     def delete(self):
         back = self.request.get("destination", self.request.referer or "/")
+        person = self.person
+        if person:
+            ticket_id = self.session.get("ticket_id")
+            if ticket_id:
+                forget_ticket(person, ticket_id)
+            forget_person(person.name)
+            # revokes copies of the session cookie as well
+            bump_session_epoch(person.name)
         self.person = None
         self.ticket = None
+        self.session.pop("epoch")
         self.redirect(back)
 
 
 class PersonHandler(BaseHandler):
 
+    PAGE_SIZE = 20
+
     def get(self, person):
-        author = VLAAH.find("~" + person)
-        if not isinstance(author, vlaah.Person):
+        author = find_person("~" + person)
+        if not author:
             self.error(404)
             return
-        documents = Document.get_by_author(author)
-        self.render("person.html", author=author, documents=documents)
+        try:
+            documents, cursor = Document.page_by_author(
+                author, self.PAGE_SIZE, self.request.get("page") or None
+            )
+        except ValueError:
+            self.error(400)
+            return
+        # documents written before titles were stored
+        Document.prefetch_current_revisions(
+            doc for doc in documents if doc.cached_title is None
+        )
+        self.render("person.html", author=author, documents=documents,
+                                   next_page=cursor)
+
+
+class SearchHandler(BaseHandler):
+
+    LIMIT = 20
+
+    def get(self):
+        query = self.request.get("q")
+        key_names = pastedown.search.search(query, self.LIMIT)
+        documents = [doc for doc in Document.get_by_key_name(key_names)
+                     if doc is not None and doc.updated_at is not None]
+        # documents written before titles were stored
+        Document.prefetch_current_revisions(
+            doc for doc in documents if doc.cached_title is None
+        )
+        documents = prefetch_authors(documents)
+        self.render("search.html", query=query, documents=documents)
 
 
 class DocumentHandler(BaseHandler):
@@ -176,23 +270,24 @@ class DocumentHandler(BaseHandler):
     TEXT_MIMES = "text/x-markdown", "text/plain"
     MIMES = TEXT_MIMES + HTML_MIMES
 
-    def find_document(self, person, id):
-        """Finds the document. Responds as 404 when the document is not
-        found.
+    def render(self, template, **kwargs):
+        """Renders the template. The document page gets functions that find
+        the forks and the recent revisions of the document, which have their
+        current revisions and authors prefetched. They are called only when
+        the sidebar is not cached.
 
         """
-        if person:
-            person = VLAAH.find("~" + person)
-            if not isinstance(person, vlaah.Person):
-                self.error(404)
-                return
-        else:
-            person = None
-        document = Document.find(person, id)
-        if not document:
-            self.error(404)
-            return
-        return document
+        if template == "document.html":
+            document = kwargs["document"]
+            def find_forks():
+                forks = document.fork_count and document.forks or ()
+                forks = Document.prefetch_current_revisions(forks)
+                return prefetch_authors(forks)
+            def find_recent_revisions():
+                return prefetch_authors(document.revisions.fetch(3))
+            kwargs["find_forks"] = find_forks
+            kwargs["find_recent_revisions"] = find_recent_revisions
+        BaseHandler.render(self, template, **kwargs)
 
     def find_revision(self, document, revision):
         if revision:
@@ -213,32 +308,103 @@ class DocumentHandler(BaseHandler):
             return False
         return True
 
+    def is_not_modified(self, etag, modified_at=None):
+        """Sets ETag and Last-Modified of the response. Returns True and
+        responds as 304 when the client has the same response already.
+        If-Modified-Since is ignored when If-None-Match is given, and when
+        modified_at is None, for responses that change with more than it.
+
+        """
+        etag = '"%s"' % etag
+        self.response.headers["ETag"] = etag
+        if modified_at is not None:
+            self.response.headers["Last-Modified"] = \
+                format_http_date(modified_at)
+        if_none_match = self.request.headers.get("If-None-Match")
+        if if_none_match:
+            etags = [tag.strip() for tag in if_none_match.split(",")]
+            etags = [tag[2:] if tag.startswith("W/") else tag for tag in etags]
+            not_modified = "*" in etags or etag in etags
+        elif modified_at is None:
+            not_modified = False
+        else:
+            since = parse_http_date(
+                self.request.headers.get("If-Modified-Since")
+            )
+            not_modified = since is not None and \
+                           modified_at.replace(microsecond=0) <= since
+        if not_modified:
+            self.response.set_status(304)
+        return not_modified
+
     def get(self, person, id,
             revision=None, document=None,
             forking_body=None, captcha_response=None):
         self.response.headers["Vary"] = "Accept"
         document = document or self.find_document(person, id)
-        revision = self.find_revision(document, revision)
-        if document:
-            mime = self.request.accept.best_match(self.MIMES)
-            if not mime:
-                self.error(406)
-                return
-            self.response.headers["Content-Type"] = mime + "; charset=utf-8"
+        if not document:
+            return
+        mime = self.request.accept.best_match(self.MIMES)
+        if not mime:
+            self.error(406)
+            return
+        self.response.headers["Content-Type"] = mime + "; charset=utf-8"
+        permalink = bool(revision)
+        if permalink:
+            revision = self.find_revision(document, revision)
+            revision_key = revision.key()
+        else:
+            revision_key = Document.cached_revision \
+                                   .get_value_for_datastore(document)
+            if revision_key is None:
+                revision = self.find_revision(document, None)
+                revision_key = revision.key()
+        if self.request.method == "GET":
+            # a revision never changes, but its page also shows the state of
+            # the document and the signed person
             if mime in self.HTML_MIMES:
-                self.render("document.html",
-                            document=document, revision=revision,
-                            mime=mime, xhtml=mime == "application/xhtml+xml",
-                            forking_body=forking_body,
-                            captcha_response=captcha_response)
-            elif mime in self.TEXT_MIMES:
-                self.response.out.write(revision.body.encode("utf-8"))
+                self.response.headers["Vary"] = "Accept, Cookie"
+                self.response.headers["Cache-Control"] = "private, no-cache"
+                # the page also changes when forks are edited or someone signs
+                # in, so only the etag tells whether it is modified
+                modified_at = None
+                # the sidebar lists forks, whose edits invalidate it
+                etag = [mime, revision_key, document.updated_at,
+                        pastedown.fragment.generation(document),
+                        self.session.get("person_name") or "",
+                        os.environ.get("CURRENT_VERSION_ID", "")]
+            elif permalink:
+                self.response.headers["Cache-Control"] = \
+                    "public, max-age=31536000"
+                modified_at = revision.created_at
+                etag = [mime, revision_key]
+            else:
+                self.response.headers["Cache-Control"] = "public, no-cache"
+                modified_at = document.updated_at
+                etag = [mime, revision_key]
+            etag = hashlib.sha1(" ".join(map(str, etag))).hexdigest()
+            if self.is_not_modified(etag, modified_at):
+                return
+        revision = revision or document.current_revision
+        if mime in self.HTML_MIMES:
+            self.render("document.html",
+                        document=document, revision=revision,
+                        mime=mime, xhtml=mime == "application/xhtml+xml",
+                        forking_body=forking_body,
+                        captcha_response=captcha_response)
+        elif mime in self.TEXT_MIMES:
+            self.response.out.write(revision.body.encode("utf-8"))
 
     def put(self, person, id):
         document = self.find_document(person, id)
         if not (document and self.assert_modifiability(document)):
             return
-        document.body = self.request.get("body")
+        try:
+            document.body = self.request.get("body")
+        except DeletedDocumentError:
+            # deleted after it was found
+            self.error(404)
+            return
         self.get(person, id, document=document)
 
     def post(self, person, id, revision=None):
@@ -265,19 +431,60 @@ class DocumentHandler(BaseHandler):
         self.redirect("/~%s/" % person)
 
 
-application = beaker.middleware.SessionMiddleware(
+class HistoryHandler(BaseHandler):
+
+    PAGE_SIZE = 20
+
+    def get(self, person, id):
+        document = self.find_document(person, id)
+        if not document:
+            return
+        try:
+            revisions, token = document.revisions.page(
+                self.PAGE_SIZE, self.request.get("page") or None
+            )
+        except ValueError:
+            self.error(400)
+            return
+        revisions = prefetch_authors(revisions)
+        self.render("history.html", document=document, revisions=revisions,
+                                    next_page=token)
+
+
+class MigrationHandler(webapp.RequestHandler):
+
+    def post(self, name):
+        """Starts the migration job."""
+        try:
+            pastedown.migration.run(name)
+        except ValueError:
+            self.error(404)
+            return
+        self.response.headers["Content-Type"] = "text/plain"
+        self.response.out.write("started %s\n" % name)
+
+
+pastedown.instrument.install()
+application = pastedown.session.SessionMiddleware(
     WSGIApplication([
         (r"/", HomeHandler),
         (r"/login/?", LoginHandler),
+        (r"/search/?", SearchHandler),
+        (r"/admin/migrate/(?P<name>\w+)/?", MigrationHandler),
         (r"/(?:%7[Ee]|~)(?P<person>[-_.a-z0-9]{3,32})/?", PersonHandler),
         (r"/(?P<person>)(?P<id>[^~/][^/]{5,})/?", DocumentHandler),
+        (r"/(?P<person>)(?P<id>[^~/][^/]{5,})/history/?", HistoryHandler),
         (r"/(?P<person>)(?P<id>[^~/][^/]{5,})"
          r"/(?P<rev>\d{4}/\d\d/\d\d/\d{6}.\d+)", DocumentHandler),
         (r"/(?:%7[Ee]|~)(?P<person>[-_.a-z0-9]{3,32})/(?P<id>[^/]+)/?",
          DocumentHandler),
+        (r"/(?:%7[Ee]|~)(?P<person>[-_.a-z0-9]{3,32})/(?P<id>[^/]+)"
+         r"/history/?", HistoryHandler),
         (r"/(?:%7[Ee]|~)(?P<person>[-_.a-z0-9]{3,32})/(?P<id>[^/]+)"
          r"/(?P<rev>\d{4}/\d\d/\d\d/\d{6}.\d+)", DocumentHandler),
-    ], debug=True),
-    BEAKER_SESSION_OPTIONS
+    ], debug=True, max_body_size=MAX_BODY_SIZE),
+    VLAAH.appkey, **pastedown.session.settings()
+)
+application = pastedown.instrument.InstrumentMiddleware(
+    application, **pastedown.instrument.settings()
 )
-
@@ -1,12 +1,4 @@
 import sys
-try:
-    import cStringIO as StringIO
-except ImportError:
-    import StringIO
-try:
-    from urlparse import parse_qs, parse_qsl
-except ImportError:
-    from cgi import parse_qs
 import cgi
 from google.appengine.ext import webapp
 import webob
@@ -35,20 +27,40 @@ class Request(webapp.Request):
 
 
 class WSGIApplication(webapp.WSGIApplication):
-    """Patched version of google.appengine.ext.webapp.WSGIApplication."""
+    """Patched version of google.appengine.ext.webapp.WSGIApplication.
+    A POST request can override its method by the X-HTTP-Method-Override
+    header or the ``__method__`` form field, and request bodies larger than
+    max_body_size are refused with 413.
+
+    """
 
     REQUEST_CLASS = Request
+    FORM_TYPES = "application/x-www-form-urlencoded", "multipart/form-data"
+
+    def __init__(self, url_mapping, debug=False, max_body_size=None):
+        webapp.WSGIApplication.__init__(self, url_mapping, debug)
+        self.max_body_size = max_body_size
 
     def __call__(self, environ, start_response):
         """Called by WSGI when a request comes in."""
-        environ = dict(environ)
+        try:
+            length = int(environ.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            length = 0
+        if self.max_body_size is not None and length > self.max_body_size:
+            start_response("413 Request Entity Too Large",
+                           [("Content-Type", "text/plain")])
+            return ["The request body is larger than %d bytes.\n"
+                    % self.max_body_size]
         environ["ORIGINAL_REQUEST_METHOD"] = environ["REQUEST_METHOD"]
-        if environ["REQUEST_METHOD"].upper() == "POST" and \
-           environ["CONTENT_TYPE"] == "application/x-www-form-urlencoded":
-            data = environ["wsgi.input"].read()
-            environ["wsgi.input"] = StringIO.StringIO(data)
-            data = parse_qs(data)
-            if "__method__" in data:
-                environ["REQUEST_METHOD"] = data["__method__"][0].upper()
+        if environ["REQUEST_METHOD"].upper() == "POST":
+            method = environ.get("HTTP_X_HTTP_METHOD_OVERRIDE")
+            content_type = environ.get("CONTENT_TYPE", "").split(";")[0]
+            if not method and content_type.strip() in self.FORM_TYPES:
+                # webob keeps the parsed form in the environ, so the request
+                # of the handler reuses it instead of parsing the body again
+                method = self.REQUEST_CLASS(environ).POST.get("__method__")
+            if method:
+                environ["REQUEST_METHOD"] = method.upper()
         return webapp.WSGIApplication.__call__(self, environ, start_response)
 
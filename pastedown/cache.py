@@ -0,0 +1,167 @@
+import time
+from google.appengine.api import memcache
+
+
+class LRUCache(object):
+    """Size-bounded in-process cache. It evicts the least recently used
+    entries first when the total weight of entries exceeds its size.
+    Entries also expire after the time in seconds unless it is zero.
+
+    """
+
+    PREV, NEXT, KEY, VALUE, WEIGHT, EXPIRES = xrange(6)
+
+    def __init__(self, size, weigh=None, time=0):
+        if not isinstance(size, (int, long)):
+            raise TypeError("size must be an integer, not "
+                            + type(size).__name__)
+        elif size < 1:
+            raise ValueError("size must be greater than zero")
+        self.size = size
+        self.weigh = weigh or (lambda value: 1)
+        self.time = time
+        self.weight = 0
+        self.map = {}
+        self.root = root = []
+        root[:] = [root, root, None, None, 0, None]
+
+    def get(self, key, default=None):
+        """Returns the cached value of the key, or the default value when
+        the key is missing.
+
+        """
+        try:
+            link = self.map[key]
+        except KeyError:
+            return default
+        expires = link[self.EXPIRES]
+        if expires is not None and expires < time.time():
+            self.delete(key)
+            return default
+        self._unlink(link)
+        self._append(link)
+        return link[self.VALUE]
+
+    def set(self, key, value):
+        """Caches the value under the key."""
+        weight = self.weigh(value)
+        self.delete(key)
+        if weight > self.size:
+            return
+        expires = self.time and time.time() + self.time or None
+        link = [None, None, key, value, weight, expires]
+        self._append(link)
+        self.map[key] = link
+        self.weight += weight
+        while self.weight > self.size:
+            self.delete(self.root[self.NEXT][self.KEY])
+
+    def delete(self, key):
+        """Removes the key. Does nothing when the key is missing."""
+        link = self.map.pop(key, None)
+        if link is not None:
+            self._unlink(link)
+            self.weight -= link[self.WEIGHT]
+
+    def clear(self):
+        """Removes all entries."""
+        self.map.clear()
+        self.root[:] = [self.root, self.root, None, None, 0, None]
+        self.weight = 0
+
+    def _append(self, link):
+        root = self.root
+        last = root[self.PREV]
+        link[self.PREV] = last
+        link[self.NEXT] = root
+        last[self.NEXT] = root[self.PREV] = link
+
+    def _unlink(self, link):
+        prev, next = link[self.PREV], link[self.NEXT]
+        prev[self.NEXT] = next
+        next[self.PREV] = prev
+
+    def __contains__(self, key):
+        return key in self.map
+
+    def __len__(self):
+        return len(self.map)
+
+
+class Cache(object):
+    """Two-level cache that puts a process-local LRUCache in front of
+    memcache. Keys are prefixed with the version, so bumping the version
+    invalidates every entry made by older versions.
+
+    """
+
+    def __init__(self, namespace, size=1000, weigh=None, time=0,
+                 version=None):
+        self.namespace = namespace
+        self.local = LRUCache(size, weigh, time)
+        self.time = time
+        self.version = version
+
+    def make_key(self, key):
+        """Returns the memcache key for the key."""
+        key = str(key)
+        if self.version is None:
+            return key
+        return "%s:%s" % (self.version, key)
+
+    def get(self, key):
+        """Returns the cached value of the key. None when it is missing."""
+        key = self.make_key(key)
+        value = self.local.get(key)
+        if value is None:
+            value = memcache.get(key, namespace=self.namespace)
+            if value is not None:
+                self.local.set(key, value)
+        return value
+
+    def get_multi(self, keys):
+        """Returns a dict of cached values. Missing keys are omitted."""
+        result = {}
+        missing = {}
+        for key in keys:
+            mkey = self.make_key(key)
+            value = self.local.get(mkey)
+            if value is None:
+                missing[mkey] = key
+            else:
+                result[key] = value
+        if missing:
+            values = memcache.get_multi(missing.keys(),
+                                        namespace=self.namespace)
+            for mkey, value in values.iteritems():
+                self.local.set(mkey, value)
+                result[missing[mkey]] = value
+        return result
+
+    def set(self, key, value):
+        """Caches the value under the key in both levels."""
+        key = self.make_key(key)
+        self.local.set(key, value)
+        try:
+            memcache.set(key, value, self.time, namespace=self.namespace)
+        except ValueError:
+            # too large to be stored in memcache
+            pass
+
+    def set_multi(self, mapping):
+        """Caches all values of the mapping in both levels."""
+        values = {}
+        for key, value in mapping.iteritems():
+            key = self.make_key(key)
+            self.local.set(key, value)
+            values[key] = value
+        try:
+            memcache.set_multi(values, self.time, namespace=self.namespace)
+        except ValueError:
+            pass
+
+    def delete(self, key):
+        """Removes the key from both levels."""
+        key = self.make_key(key)
+        self.local.delete(key)
+        memcache.delete(key, namespace=self.namespace)
@@ -0,0 +1,81 @@
+import random
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+
+SHARDS = 20
+MEMCACHE_NAMESPACE = "counter"
+
+
+class CounterShard(db.Model):
+    """A shard of a named counter. Increments pick a random shard, so
+    concurrent writers of the same counter rarely contend.
+
+    """
+
+    name = db.StringProperty(required=True)
+    count = db.IntegerProperty(required=True, default=0)
+
+    @classmethod
+    def key_names(cls, name):
+        """Returns the key names of all shards of the counter."""
+        return ["%s:%d" % (name, i) for i in xrange(SHARDS)]
+
+
+def get(name):
+    """Returns the value of the counter."""
+    return get_multi([name])[name]
+
+
+def get_multi(names):
+    """Returns a dict of values of the counters. Shards of counters missing
+    in memcache are summed up by one batch get.
+
+    """
+    names = list(names)
+    counts = memcache.get_multi(names, namespace=MEMCACHE_NAMESPACE)
+    missing = [name for name in names if name not in counts]
+    if missing:
+        key_names = []
+        for name in missing:
+            key_names.extend(CounterShard.key_names(name))
+        summed = dict((name, 0) for name in missing)
+        for shard in CounterShard.get_by_key_name(key_names):
+            if shard is not None:
+                summed[shard.name] += shard.count
+        memcache.add_multi(summed, namespace=MEMCACHE_NAMESPACE)
+        counts.update(summed)
+    return counts
+
+
+def increment(name, delta=1):
+    """Adds the delta to the counter. The delta can be negative."""
+    key_name = "%s:%d" % (name, random.randrange(SHARDS))
+    def txn():
+        shard = CounterShard.get_by_key_name(key_name)
+        if shard is None:
+            shard = CounterShard(key_name=key_name, name=name)
+        shard.count += delta
+        shard.put()
+    db.run_in_transaction(txn)
+    if delta >= 0:
+        memcache.incr(name, delta, namespace=MEMCACHE_NAMESPACE)
+    else:
+        memcache.delete(name, namespace=MEMCACHE_NAMESPACE)
+
+
+def reset(name, value=0):
+    """Sets the counter to the value, e.g. when it is recounted."""
+    shards = [CounterShard(key_name=key_name, name=name)
+              for key_name in CounterShard.key_names(name)]
+    shards[0].count = value
+    db.put(shards)
+    memcache.delete(name, namespace=MEMCACHE_NAMESPACE)
+
+
+def delete(name):
+    """Removes the counter."""
+    keys = [db.Key.from_path(CounterShard.kind(), key_name)
+            for key_name in CounterShard.key_names(name)]
+    db.delete(keys)
+    memcache.delete(name, namespace=MEMCACHE_NAMESPACE)
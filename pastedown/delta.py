@@ -0,0 +1,36 @@
+import difflib
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+
+def diff(old, new):
+    """Returns the line-based delta from the old text to the new text as a
+    JSON string of ``[start, end, text]`` replacements of old lines.
+
+    """
+    old_lines = old.splitlines(True)
+    new_lines = new.splitlines(True)
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines)
+    replacements = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag != "equal":
+            replacements.append([i1, i2, u"".join(new_lines[j1:j2])])
+    return json.dumps(replacements, separators=(",", ":"))
+
+
+def patch(old, delta):
+    """Applies the delta made by diff() to the old text, and returns the new
+    text.
+
+    """
+    lines = old.splitlines(True)
+    result = []
+    position = 0
+    for start, end, text in json.loads(delta):
+        result.extend(lines[position:start])
+        result.append(text)
+        position = end
+    result.extend(lines[position:])
+    return u"".join(result)
@@ -0,0 +1,165 @@
+import datetime
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+from google.appengine.api import datastore
+from google.appengine.ext import db
+import pastedown.counter
+import pastedown.migration
+from pastedown.model import *
+
+
+MODELS = Document, Revision, Content
+BATCH_SIZE = 100
+
+
+def encode_key(key):
+    """Encodes the key as its path."""
+    return key.to_path()
+
+
+def decode_key(path):
+    """Decodes the key path. Numeric ids become names like ``id123``, so
+    imported entities and references to them get the same keys without a
+    map from old ids to new ones.
+
+    """
+    path = list(path)
+    for i in xrange(1, len(path), 2):
+        if isinstance(path[i], (int, long)):
+            path[i] = "id%d" % path[i]
+    return db.Key.from_path(*path)
+
+
+def encode_value(value):
+    """Encodes the datastore value as a JSON value."""
+    if isinstance(value, db.Key):
+        return {"key": encode_key(value)}
+    elif isinstance(value, datetime.datetime):
+        return {"datetime": value.isoformat()}
+    elif isinstance(value, list):
+        return [encode_value(v) for v in value]
+    return value
+
+
+def decode_value(value, property=None):
+    """Decodes the JSON value as a datastore value of the property."""
+    if isinstance(value, dict):
+        if "key" in value:
+            return decode_key(value["key"])
+        timestamp = value["datetime"]
+        result = datetime.datetime.strptime(timestamp[:19],
+                                            "%Y-%m-%dT%H:%M:%S")
+        if len(timestamp) > 20:
+            result = result.replace(microsecond=int(timestamp[20:]))
+        return result
+    elif isinstance(value, list):
+        return [decode_value(v) for v in value]
+    elif isinstance(property, db.TextProperty) and value is not None:
+        return db.Text(value)
+    return value
+
+
+def dump_entity(entity):
+    """Dumps the entity as a JSON object of its kind, key path and
+    datastore values.
+
+    """
+    properties = {}
+    for property in entity.properties().itervalues():
+        value = property.get_value_for_datastore(entity)
+        properties[property.name] = encode_value(value)
+    return {"kind": entity.kind(), "key": encode_key(entity.key()),
+            "properties": properties}
+
+
+def load_entity(record):
+    """Loads the low-level entity from the JSON object of dump_entity()."""
+    model = db.class_for_kind(record["kind"])
+    properties = dict((property.name, property)
+                      for property in model.properties().itervalues())
+    unindexed = [name for name, property in properties.iteritems()
+                 if not property.indexed]
+    key = decode_key(record["key"])
+    entity = datastore.Entity(key.kind(), parent=key.parent(),
+                              name=key.name(), unindexed_properties=unindexed)
+    for name, value in record["properties"].iteritems():
+        entity[name] = decode_value(value, properties.get(name))
+    return entity
+
+
+def export_entities(write):
+    """Writes every document, revision and content as a line of JSON by the
+    write function. Entities are read by batches with query cursors, so
+    memory use does not grow with the number of entities.
+
+    """
+    for model in MODELS:
+        cursor = None
+        while True:
+            entities, cursor = pastedown.migration.fetch_batch(model.all(),
+                                                               cursor,
+                                                               BATCH_SIZE)
+            for entity in entities:
+                write(json.dumps(dump_entity(entity)) + "\n")
+            if not cursor:
+                break
+
+
+def import_entities(lines):
+    """Imports the entities from lines written by export_entities(). They
+    are put by batches, and a fork is put only after its parent document, so
+    fork references never point to a missing document while importing.
+    Counters of revisions and forks and the recent documents are rebuilt at
+    the end.
+
+    """
+    batch = []
+    written = set()
+    waiting = {}
+    revisions = {}
+    forks = {}
+    def put(record):
+        batch.append(load_entity(record))
+        if len(batch) >= BATCH_SIZE:
+            datastore.Put(batch)
+            del batch[:]
+    def put_document(record):
+        key_name = decode_key(record["key"]).name()
+        put(record)
+        written.add(key_name)
+        revisions.setdefault(key_name, 0)
+        for fork in waiting.pop(key_name, ()):
+            put_document(fork)
+    for line in lines:
+        record = json.loads(line)
+        if record["kind"] == Document.kind():
+            parent = record["properties"].get("parent_document")
+            parent = parent and decode_key(parent["key"]).name()
+            if parent:
+                forks[parent] = forks.get(parent, 0) + 1
+            if parent and parent not in written:
+                waiting.setdefault(parent, []).append(record)
+            else:
+                put_document(record)
+        elif record["kind"] == Revision.kind():
+            key = decode_key(record["key"])
+            document = record["properties"]["document"]
+            if key.parent() == decode_key(document["key"]):
+                key_name = key.parent().name()
+                revisions[key_name] = revisions.get(key_name, 0) + 1
+            put(record)
+        else:
+            put(record)
+    # forks of documents missing in the dump
+    for records in waiting.values():
+        for record in records:
+            put(record)
+    if batch:
+        datastore.Put(batch)
+    for key_name, count in revisions.iteritems():
+        key = db.Key.from_path(Document.kind(), key_name)
+        pastedown.counter.reset("revisions:%s" % key, count)
+        pastedown.counter.reset("forks:%s" % key, forks.get(key_name, 0))
+    pastedown.migration.rebuild_recent_documents()
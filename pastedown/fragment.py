@@ -0,0 +1,100 @@
+import os
+import uuid
+import jinja2.ext
+import jinja2.nodes
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+
+MEMCACHE_NAMESPACE = "fragment"
+TIME = 24 * 60 * 60
+
+
+def dependency_key(dependency):
+    """Returns the memcache key of the generation of the dependency, which
+    is an entity or a string.
+
+    """
+    if isinstance(dependency, db.Model):
+        dependency = dependency.key()
+    return "generation:%s" % dependency
+
+
+def invalidate(*dependencies):
+    """Invalidates every fragment that depends on any of the dependencies.
+    Call it after the dependencies are written. None values are ignored.
+
+    """
+    keys = [dependency_key(dependency)
+            for dependency in dependencies if dependency is not None]
+    memcache.delete_multi(keys, namespace=MEMCACHE_NAMESPACE)
+
+
+def generation(dependency):
+    """Returns the current generation of the dependency, which changes
+    whenever it is invalidated. It is a new random one every time when
+    memcache is unavailable.
+
+    """
+    key = dependency_key(dependency)
+    value = memcache.get(key, namespace=MEMCACHE_NAMESPACE)
+    if value is None:
+        value = uuid.uuid4().hex
+        if not memcache.add(key, value, namespace=MEMCACHE_NAMESPACE):
+            value = memcache.get(key, namespace=MEMCACHE_NAMESPACE) or value
+    return value
+
+
+def cached(name, dependencies, render):
+    """Returns the fragment of the name, which is rendered by calling the
+    render function and then cached until any of the dependencies are
+    invalidated. A cached fragment is stored together with the generations of
+    its dependencies, so a hit costs one memcache get.
+
+    """
+    dependencies = [dependency_key(dependency) for dependency in dependencies]
+    key = "%s:%s:%s" % (os.environ.get("CURRENT_VERSION_ID", ""), name,
+                        ",".join(dependencies))
+    values = memcache.get_multi([key] + dependencies,
+                                namespace=MEMCACHE_NAMESPACE)
+    if key in values:
+        generations, fragment = values[key]
+        if generations == [values.get(dep) for dep in dependencies]:
+            return fragment
+    # generations are read before rendering, so an invalidation during the
+    # rendering leaves the stored fragment invalid rather than stale
+    missing = dict((dep, uuid.uuid4().hex)
+                   for dep in dependencies if dep not in values)
+    if missing:
+        memcache.add_multi(missing, namespace=MEMCACHE_NAMESPACE)
+        values.update(memcache.get_multi(missing.keys(),
+                                         namespace=MEMCACHE_NAMESPACE))
+    generations = [values.get(dep) for dep in dependencies]
+    fragment = render()
+    if None not in generations:
+        memcache.set(key, (generations, fragment), TIME,
+                     namespace=MEMCACHE_NAMESPACE)
+    return fragment
+
+
+class FragmentCacheExtension(jinja2.ext.Extension):
+    """Adds the ``{% cache name, dependency, ... %}`` tag, which caches its
+    body by cached() until ``{% endcache %}``.
+
+    """
+
+    tags = set(["cache"])
+
+    def parse(self, parser):
+        lineno = parser.stream.next().lineno
+        name = parser.parse_expression()
+        dependencies = []
+        while parser.stream.skip_if("comma"):
+            dependencies.append(parser.parse_expression())
+        body = parser.parse_statements(["name:endcache"], drop_needle=True)
+        call = self.call_method("_cache",
+                                [name, jinja2.nodes.List(dependencies)])
+        return jinja2.nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+    def _cache(self, name, dependencies, caller):
+        return cached(name, dependencies, caller)
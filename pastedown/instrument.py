@@ -0,0 +1,176 @@
+import time
+import random
+import logging
+import cProfile
+import pstats
+import threading
+try:
+    import cStringIO as StringIO
+except ImportError:
+    import StringIO
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+from google.appengine.api import apiproxy_stub_map
+import pastedown
+import pastedown.model
+import pastedown.session
+
+
+# VLAAH and reCAPTCHA are both HTTP APIs, called by urlfetch RPCs
+SERVICES = {"datastore_v3": "datastore", "memcache": "memcache",
+            "urlfetch": "urlfetch"}
+CATEGORIES = "datastore", "memcache", "urlfetch", "markdown", "render", \
+             "session"
+PROFILE_LIMIT = 30
+
+_local = threading.local()
+
+
+class RequestStats(object):
+    """Calls and seconds spent per category during a request. Categories
+    may nest, e.g. render includes datastore calls made by templates.
+
+    """
+
+    def __init__(self):
+        self.counts = dict((category, 0) for category in CATEGORIES)
+        self.times = dict((category, 0.0) for category in CATEGORIES)
+
+    def add(self, category, seconds):
+        self.counts[category] = self.counts.get(category, 0) + 1
+        self.times[category] = self.times.get(category, 0.0) + seconds
+
+    def server_timing(self, total):
+        """Returns the value of the Server-Timing header."""
+        metrics = ["%s;dur=%.1f;desc=\"%d calls\"" %
+                   (category, self.times[category] * 1000,
+                    self.counts[category])
+                   for category in CATEGORIES if self.counts[category]]
+        metrics.append("total;dur=%.1f" % (total * 1000))
+        return ", ".join(metrics)
+
+    def to_dict(self):
+        return dict((category, {"calls": self.counts[category],
+                                "ms": round(self.times[category] * 1000, 1)})
+                    for category in CATEGORIES)
+
+
+def record(category, seconds):
+    """Records a call of the category that took the seconds. It is ignored
+    outside requests, e.g. in tasks.
+
+    """
+    stats = getattr(_local, "stats", None)
+    if stats is not None:
+        stats.add(category, seconds)
+
+
+def timed(category, function):
+    """Wraps the function so that its calls are recorded in the category."""
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            record(category, time.time() - start)
+    wrapper.__name__ = function.__name__
+    wrapper.__doc__ = function.__doc__
+    return wrapper
+
+
+def install_hooks():
+    """Times datastore, memcache and urlfetch RPCs by apiproxy hooks."""
+    starts = {}
+    def before(service, call, request, response, *args):
+        starts[id(request)] = time.time()
+    def after(service, call, request, response, *args):
+        start = starts.pop(id(request), None)
+        if start is not None:
+            record(SERVICES[service], time.time() - start)
+    for service in SERVICES:
+        apiproxy_stub_map.apiproxy.GetPreCallHooks() \
+                                  .Append("instrument", before, service)
+        apiproxy_stub_map.apiproxy.GetPostCallHooks() \
+                                  .Append("instrument", after, service)
+
+
+def install():
+    """Instruments RPCs, Markdown conversions and session store loads and
+    saves. VLAAH calls, including ticket lookups and lazily loaded people,
+    and reCAPTCHA checks are counted together as urlfetch RPCs. Templates
+    are timed by BaseHandler.render().
+
+    """
+    install_hooks()
+    markdown = pastedown.model.MARKDOWN
+    markdown.convert = timed("markdown", markdown.convert)
+    for store in pastedown.session.STORES.itervalues():
+        store.load = timed("session", store.load)
+        store.save = timed("session", store.save)
+
+
+def settings():
+    """Reads the optional ``[instrument]`` section: ``profile_rate`` is the
+    fraction of requests to profile, and profiles of requests slower than
+    ``slow_ms`` are logged.
+
+    """
+    config = pastedown.configuration("instrument", optional=True)
+    return {"profile_rate": float(config.get("profile_rate", 0)),
+            "slow": float(config.get("slow_ms", 1000)) / 1000}
+
+
+class InstrumentMiddleware(object):
+    """WSGI middleware that reports the calls and times of each category
+    per request, in the Server-Timing header and a JSON log line. A sample
+    of requests is profiled by cProfile, and the profiles of the slow ones
+    are logged.
+
+    """
+
+    def __init__(self, application, profile_rate=0.0, slow=1.0):
+        self.application = application
+        self.profile_rate = profile_rate
+        self.slow = slow
+
+    def __call__(self, environ, start_response):
+        stats = _local.stats = RequestStats()
+        profile = None
+        if self.profile_rate and random.random() < self.profile_rate:
+            profile = cProfile.Profile()
+        start = time.time()
+        status = []
+        def instrumented_start_response(code, headers, exc_info=None):
+            status.append(code)
+            timing = stats.server_timing(time.time() - start)
+            headers = headers + [("Server-Timing", timing)]
+            return start_response(code, headers, exc_info)
+        try:
+            if profile:
+                return profile.runcall(self.application, environ,
+                                       instrumented_start_response)
+            return self.application(environ, instrumented_start_response)
+        finally:
+            _local.stats = None
+            elapsed = time.time() - start
+            self.log(environ, status and status[0], elapsed, stats)
+            if profile and elapsed >= self.slow:
+                self.log_profile(environ, profile)
+
+    def log(self, environ, status, elapsed, stats):
+        line = stats.to_dict()
+        line.update(method=environ.get("REQUEST_METHOD"),
+                    path=environ.get("PATH_INFO"),
+                    status=status and int(status.split()[0]),
+                    ms=round(elapsed * 1000, 1))
+        logging.info("request %s", json.dumps(line, sort_keys=True))
+
+    def log_profile(self, environ, profile):
+        output = StringIO.StringIO()
+        stats = pstats.Stats(profile, stream=output)
+        stats.sort_stats("cumulative").print_stats(PROFILE_LIMIT)
+        logging.warning("slow request %s %s\n%s",
+                        environ.get("REQUEST_METHOD"),
+                        environ.get("PATH_INFO"), output.getvalue())
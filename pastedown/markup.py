@@ -0,0 +1,86 @@
+import re
+
+
+WHITESPACE_LINE_PATTERN = re.compile(ur"^[ \t]+$", re.M)
+BLANK_LINES_PATTERN = re.compile(ur"\n{2,}")
+LIST_ITEM_PATTERN = re.compile(ur"(?:[*+-]|\d+\.)[ \t]")
+NESTED_PATTERN = re.compile(ur"^[ \t]*(?:>|(?:[*+-]|\d+\.)[ \t])", re.M)
+H1_HINT_PATTERN = re.compile(ur"""
+    ^((?:[ \t>]|[*+-][ \t]|\d+\.[ \t])*)  # quote, list or indent prefix
+    (?:\#(?!\#)|=+[ \t]*$)                 # atx or setext level 1
+""", re.M | re.X)
+HTML_PATTERN = re.compile(ur"^[ \t]*<|<h1", re.M)
+LINK_DEFINITION_PATTERN = re.compile(ur"""
+    ^[ ]{0,3}\[.+\]:[ \t]*\n?[ \t]*<?.+?>?[ \t]*
+    (?:\n?[ \t]*(?<=\s)['"(][^\n]*['")][ \t]*)?
+    (?:\n+|\Z)
+""", re.M | re.X)
+
+
+def normalize(text):
+    """Normalizes line endings and whitespace-only lines the same way
+    markdown2 does before parsing.
+
+    """
+    text = text.replace(u"\r\n", u"\n").replace(u"\r", u"\n")
+    return WHITESPACE_LINE_PATTERN.sub(u"", text + u"\n\n")
+
+
+def is_global(text):
+    """Returns True when the Markdown text has constructs that make its
+    blocks depend on each other: raw HTML, which may span blank lines, and
+    footnotes, which are numbered over the whole document.
+
+    """
+    return u"[^" in text or HTML_PATTERN.search(text) is not None
+
+
+def blocks(text):
+    """Splits the normalized Markdown text into top-level blocks lazily.
+    A block ends only before a line that cannot continue a list, quote or
+    code block, so each block renders the same alone as in the whole text.
+    Yields the end offset of each block.
+
+    """
+    for match in BLANK_LINES_PATTERN.finditer(text):
+        start = match.end()
+        if start >= len(text):
+            break
+        char = text[start]
+        if char.isspace() or char == u">" or \
+           LIST_ITEM_PATTERN.match(text, start):
+            continue
+        yield match.start()
+    yield len(text.rstrip(u"\n"))
+
+
+def may_have_h1(block):
+    """Returns True when the block possibly renders an <h1>. Indented lines
+    that start with # are code unless the block has lists or quotes.
+
+    """
+    nested = None
+    for match in H1_HINT_PATTERN.finditer(block):
+        prefix = match.group(1)
+        if not prefix:
+            return True
+        elif nested is None:
+            nested = NESTED_PATTERN.search(block) is not None
+        if nested or prefix.strip(u" \t"):
+            return True
+    return False
+
+
+def strip_link_definitions(text):
+    """Strips link definitions from the normalized Markdown text, as markdown2
+    does before splitting it into blocks. Returns the stripped text and the
+    definitions, which have to be appended to a part of the text rendered
+    alone.
+
+    """
+    definitions = []
+    def strip(match):
+        definitions.append(match.group(0).rstrip(u"\n") + u"\n")
+        return u""
+    text = LINK_DEFINITION_PATTERN.sub(strip, text)
+    return text, u"".join(definitions)
@@ -0,0 +1,189 @@
+from google.appengine.ext import db, deferred
+import pastedown.counter
+import pastedown.search
+from pastedown.model import *
+
+
+BATCH_SIZE = 100
+JOBS = ("backfill_titles", "backfill_current_revisions", "index_lineage",
+        "count_revisions", "rebuild_recent_documents", "index_documents")
+
+
+def run(name):
+    """Starts the migration job of the name in the background. Each job
+    processes a batch of entities and then defers itself with the query
+    cursor, so it can run over any number of entities.
+
+    """
+    if name not in JOBS:
+        raise ValueError("no such migration job: " + name)
+    deferred.defer(globals()[name])
+
+
+def fetch_batch(query, cursor=None, size=BATCH_SIZE):
+    """Fetches a batch of entities from the query. Returns the entities and
+    the cursor for the next batch, which is None at the end.
+
+    """
+    if cursor:
+        query.with_cursor(cursor)
+    entities = query.fetch(size)
+    if len(entities) < size:
+        return entities, None
+    return entities, query.cursor()
+
+
+def update(key, change, *args):
+    """Gets the entity of the key again and calls change(entity, *args) in
+    a transaction, so a job never puts back a stale copy over what requests
+    wrote meanwhile. The entity is put only when change() returns True.
+    Entities deleted meanwhile are skipped.
+
+    """
+    def txn():
+        entity = db.get(key)
+        if entity is not None and change(entity, *args):
+            db.put(entity)
+    db.run_in_transaction(txn)
+
+
+def backfill_titles(cursor=None):
+    """Stores titles of revisions written before titles were stored at write
+    time, and then does the same for documents.
+
+    """
+    revisions, cursor = fetch_batch(Revision.all(), cursor)
+    def store_title(revision, title):
+        if revision.cached_title is None:
+            revision.cached_title = title
+            return True
+    for revision in revisions:
+        if revision.cached_title is None:
+            title = create_title(revision.html) or u""
+            update(revision.key(), store_title, title)
+    if cursor:
+        deferred.defer(backfill_titles, cursor)
+    else:
+        deferred.defer(backfill_document_titles)
+
+
+def backfill_document_titles(cursor=None):
+    """Stores titles of documents from their current revisions. Hidden
+    documents, which are deleted or have nothing written yet, are skipped.
+
+    """
+    documents, cursor = fetch_batch(Document.all(), cursor)
+    def store_title(document, title):
+        if document.cached_title is None and document.updated_at:
+            document.cached_title = title
+            return True
+    for document in documents:
+        if document.cached_title is None and document.updated_at:
+            revision = document.current_revision
+            if revision and revision.cached_title is not None:
+                update(document.key(), store_title, revision.cached_title)
+    if cursor:
+        deferred.defer(backfill_document_titles, cursor)
+
+
+def backfill_current_revisions(cursor=None):
+    """Stores the current revisions of documents written before they were
+    stored on documents. Hidden documents are skipped.
+
+    """
+    documents, cursor = fetch_batch(Document.all(), cursor)
+    def store_revision(document, revision):
+        stored = Document.cached_revision.get_value_for_datastore(document)
+        if stored is None and document.updated_at:
+            document.cached_revision = revision
+            return True
+    for document in documents:
+        stored = Document.cached_revision.get_value_for_datastore(document)
+        if stored is None and document.updated_at:
+            revision = document.current_revision
+            if revision:
+                update(document.key(), store_revision, revision.key())
+    if cursor:
+        deferred.defer(backfill_current_revisions, cursor)
+
+
+def index_lineage(cursor=None):
+    """Indexes the lineage of documents written before lineages were
+    indexed, by a Document.index_lineage task for each document. The task
+    re-gets the document and marks it indexed in a transaction, and hidden
+    documents are skipped.
+
+    """
+    documents, cursor = fetch_batch(Document.all(), cursor)
+    for document in documents:
+        if not document.lineage_indexed and document.updated_at:
+            deferred.defer(Document.index_lineage, document.key())
+    if cursor:
+        deferred.defer(index_lineage, cursor)
+
+
+def count_revisions(cursor=None):
+    """Counts revisions and forks of documents written before they were
+    counted. Only documents whose lineage is indexed are counted, so run
+    index_lineage first. Hidden documents are skipped.
+
+    New revisions and forks increment the counters while they are counted,
+    so counters are moved by the difference from the recount instead of
+    being reset, and the document is marked counted in a transaction that
+    re-gets it. Only a revision or fork written between a recount and the
+    counter read can be miscounted.
+
+    """
+    documents, cursor = fetch_batch(Document.all(), cursor, 10)
+    def store_count(document, inherited):
+        if document.counted or not document.updated_at:
+            return False
+        document.inherited_revisions = inherited
+        document.counted = True
+        return True
+    for document in documents:
+        if document.counted or not document.lineage_indexed or \
+           not document.updated_at:
+            continue
+        key = document.key()
+        own = inherited = 0
+        for query in RevisionSet.walk_hierarchy(document, keys_only=True):
+            for revision in query:
+                if revision.parent() == key:
+                    own += 1
+                else:
+                    inherited += 1
+        forks = Document.all(keys_only=True).filter("parent_document =", key)
+        forks = len(list(forks))
+        for name, count in (("revisions:%s" % key, own),
+                            ("forks:%s" % key, forks)):
+            delta = count - pastedown.counter.get(name)
+            if delta:
+                pastedown.counter.increment(name, delta)
+        update(key, store_count, inherited)
+    if cursor:
+        deferred.defer(count_revisions, cursor)
+
+
+def rebuild_recent_documents():
+    """Fills the list of recent documents from the most recently updated
+    documents, e.g. when it is deployed first.
+
+    """
+    documents = Document.all().filter("updated_at != ", None) \
+                              .order("-updated_at") \
+                              .fetch(RecentDocuments.SIZE)
+    documents = prefetch_authors(documents)
+    RecentDocuments.update(map(RecentDocuments.make_entry, documents))
+
+
+def index_documents(cursor=None):
+    """Indexes documents written before the search index, by a task for
+    each document.
+
+    """
+    keys, cursor = fetch_batch(Document.all(keys_only=True), cursor)
+    for key in keys:
+        deferred.defer(pastedown.search.index_document, key.name())
+    if cursor:
+        deferred.defer(index_documents, cursor)
@@ -1,51 +1,121 @@
 import re
+import time
+import base64
 import datetime
 import itertools
 import hashlib
 import htmlentitydefs
-from google.appengine.ext import db
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+from google.appengine.api import memcache
+from google.appengine.ext import db, deferred
 import markdown2
 import vlaah
 import vlaah.gae.db as vdb
 import pastedown
+import pastedown.cache
+import pastedown.counter
+import pastedown.delta
+import pastedown.fragment
+import pastedown.markup
+import pastedown.search
 
 
 VLAAH = pastedown.vlaah_session()
-MARKDOWN = markdown2.Markdown(extras=["footnotes"])
+MARKDOWN_EXTRAS = ["footnotes"]
+MARKDOWN = markdown2.Markdown(extras=MARKDOWN_EXTRAS)
+RENDERER_VERSION = "markdown2-%s:%s" % (markdown2.__version__,
+                                        ",".join(MARKDOWN_EXTRAS))
+HTML_CACHE = pastedown.cache.Cache("html", size=8 * 1024 * 1024, weigh=len,
+                                   version=RENDERER_VERSION)
+BLOCK_CACHE = pastedown.cache.Cache("block", size=4 * 1024 * 1024, weigh=len,
+                                    version=RENDERER_VERSION)
+BODY_CACHE = pastedown.cache.Cache("body", size=4 * 1024 * 1024, weigh=len)
+REVISION_STORAGE = pastedown.revision_storage()
+PEOPLE = pastedown.cache.LRUCache(1000, time=600)
+TICKETS = pastedown.cache.LRUCache(1000, time=600)
+TICKET_VALIDITY = 60
+
+
+class DeletedDocumentError(Exception):
+    """Raised when a revision is written in a deleted document."""
 
 
 class Document(db.Model):
     """Documents written in Markdown."""
 
     KEY_NAME_LENGTH_RANGE = 6, 32
+    PURGE_STEPS = "forks", "lineage", "revisions"
+    PURGE_BATCH_SIZE = 100
 
     parent_document = db.SelfReferenceProperty(collection_name="forks")
     parent_revision = db.ReferenceProperty()
     author = vdb.PersonProperty(VLAAH, indexed=True)
-    updated_at = db.DateTimeProperty(auto_now=True)
+    updated_at = db.DateTimeProperty()
+    deleted = db.BooleanProperty(default=False)
+    cached_title = db.TextProperty(name="title")
+    cached_revision = db.ReferenceProperty(name="current_revision",
+                                           collection_name="current_documents")
+    lineage_indexed = db.BooleanProperty(default=False)
+    counted = db.BooleanProperty(default=False)
+    inherited_revisions = db.IntegerProperty(default=0)
 
     @classmethod
     def create_key_name(cls, person=None, id=None):
-        """Creates a new unique key_name for documents."""
+        """Creates a new unique key_name for documents. Candidates are checked
+        by one batch get, and the first free one is claimed in a transaction
+        so that concurrent posts of the same title cannot take the same
+        key_name.
+
+        """
         person_name = person.name + "/" if person else ""
         if isinstance(id, basestring):
             return person_name + id
         elif not callable(id) and id is not None:
             raise TypeError("id must be callable or a string; %s given"
                             % type(id).__name__)
+        while True:
+            candidates = cls.key_name_candidates(person, id)
+            documents = cls.get_by_key_name(candidates)
+            for key_name, document in itertools.izip(candidates, documents):
+                if document is None and cls.claim_key_name(key_name):
+                    return key_name
+
+    @classmethod
+    def key_name_candidates(cls, person=None, id=None):
+        """Returns a list of key_name candidates, shortest first."""
         min, max = cls.KEY_NAME_LENGTH_RANGE
-        lengths = itertools.chain(xrange(min, max), itertools.repeat(max))
+        hash = hashlib.sha512(str(datetime.datetime.now())).hexdigest()
+        lengths = xrange(min, max + 1)
         if id:
             lengths = itertools.chain([0], lengths)
+        candidates = []
         for l in lengths:
-            hash = hashlib.sha512(str(datetime.datetime.now()))
-            hash = hash.hexdigest()[:l]
-            key_name = id(hash) if id else hash
+            key_name = id(hash[:l]) if id else hash[:l]
             if key_name == "":
                 continue
             key_name = cls.create_key_name(person, key_name)
-            if not cls.get_by_key_name(key_name):
-                return key_name
+            if key_name not in candidates:
+                candidates.append(key_name)
+        return candidates
+
+    @classmethod
+    def claim_key_name(cls, key_name):
+        """Claims the key_name by storing an empty document under it unless
+        it is taken. Returns False when it is taken.
+
+        """
+        def claim():
+            if cls.get_by_key_name(key_name) is not None:
+                return False
+            db.Model.put(cls(key_name=key_name))
+            return True
+        try:
+            return db.run_in_transaction(claim)
+        except db.TransactionFailedError:
+            return False
 
     @classmethod
     def get_by_author(cls, author):
@@ -55,6 +125,43 @@ class Document(db.Model):
         typename = type(author).__name__
         raise TypeError("author must be a Person instance, not " + typename)
 
+    @classmethod
+    def page_by_author(cls, author, size, cursor=None):
+        """Returns a page of documents written by the author, recently
+        updated first, and the cursor of the next page, which is None for
+        the last page. Raises ValueError when the cursor is invalid.
+
+        """
+        query = cls.get_by_author(author).filter("updated_at >", None) \
+                                         .order("-updated_at")
+        try:
+            if cursor:
+                query.with_cursor(cursor)
+            documents = query.fetch(size)
+        except (db.BadValueError, db.BadRequestError):
+            raise ValueError("invalid cursor: %r" % cursor)
+        if len(documents) < size:
+            return documents, None
+        return documents, query.cursor()
+
+    @classmethod
+    def prefetch_current_revisions(cls, documents):
+        """Resolves the current revisions of the documents by one batch get
+        and returns the documents as a list. Documents that have no stored
+        current revision still resolve it lazily.
+
+        """
+        documents = list(documents)
+        keys = [cls.cached_revision.get_value_for_datastore(doc)
+                for doc in documents]
+        revisions = iter(db.get([key for key in keys if key is not None]))
+        for document, key in itertools.izip(documents, keys):
+            if key is not None:
+                revision = revisions.next()
+                if revision is not None:
+                    document.cached_revision = revision
+        return documents
+
     @classmethod
     def find(cls, author, id):
         key_name = cls.create_key_name(author, id)
@@ -71,11 +178,7 @@ class Document(db.Model):
                 kwargs["parent_document"] = kwargs["parent_revision"].document
             if "key_name" not in kwargs and "key" not in kwargs:
                 if "body" in kwargs and "author" in kwargs and kwargs["author"]:
-                    html = MARKDOWN.convert(kwargs["body"])
-                    title = create_title(html) or ""
-                    title = title.replace(TITLE_ELLIPSIS, "")
-                    slug = re.sub(ur"\W+", ur"-",
-                                  re.sub(ur"^\W+|\W+$", ur"", title)).lower()
+                    slug = create_slug(extract_title(kwargs["body"]))
                     def id(name):
                         if not slug:
                             return name
@@ -84,6 +187,8 @@ class Document(db.Model):
                     id = None
                 key_name = self.create_key_name(kwargs["author"], id)
                 kwargs["key_name"] = key_name
+            kwargs.setdefault("lineage_indexed", True)
+            kwargs.setdefault("counted", True)
         db.Model.__init__(self, *args, **kwargs)
 
     @property
@@ -94,6 +199,8 @@ class Document(db.Model):
     @property
     def current_revision(self):
         """The current revision. None when there is no revision."""
+        if Document.cached_revision.get_value_for_datastore(self):
+            return self.cached_revision
         for rev in self.revisions:
             return rev
 
@@ -107,6 +214,24 @@ class Document(db.Model):
         fset=lambda self, v: Revision(parent=self, document=self, body=v).put()
     )
 
+    @property
+    def revision_count(self):
+        """The number of revisions in its history, including inherited
+        ones.
+
+        """
+        if not self.counted:
+            return self.revisions.count()
+        name = "revisions:%s" % self.key()
+        return self.inherited_revisions + pastedown.counter.get(name)
+
+    @property
+    def fork_count(self):
+        """The number of documents forked from it."""
+        if not self.counted:
+            return self.forks.count()
+        return pastedown.counter.get("forks:%s" % self.key())
+
     @property
     def html(self):
         """Returns the HTML string of its body."""
@@ -116,6 +241,8 @@ class Document(db.Model):
     @property
     def title(self):
         """The title picked from its current first sentence or <h1>."""
+        if self.cached_title is not None:
+            return self.cached_title or Revision.UNTITLED
         body = self.current_revision
         return body and body.title
 
@@ -140,17 +267,261 @@ class Document(db.Model):
         return type(self)(parent_document=self, author=author, body=body)
 
     def put(self, skip_body=False):
+        forking = not self.is_saved() and \
+                  Document.parent_revision.get_value_for_datastore(self)
+        if forking:
+            # until index_lineage() is done in the background, the fork walks
+            # and counts the revisions of its ancestors
+            self.lineage_indexed = self.counted = False
         key = db.Model.put(self)
+        if forking:
+            deferred.defer(Document.index_lineage, key, count=True)
+            parent = Document.parent_document.get_value_for_datastore(self)
+            pastedown.counter.increment("forks:%s" % parent)
+            pastedown.fragment.invalidate(parent)
         if not skip_body and hasattr(self, "_body_text"):
             self.body = self._body_text
             del self._body_text
         return key
 
+    @classmethod
+    def index_lineage(cls, key, cursor=None, count=False):
+        """Adds the document of the key to the lineage of its own revisions
+        and the revisions it inherits, a batch at a time, and then marks its
+        lineage indexed. When there is more than a batch to do, the rest is
+        deferred with the cursor, and a retried batch adds nothing twice.
+        With count, it also stores how many revisions the document inherits
+        and marks it counted, which only a document whose revisions have been
+        counted since it was written may be.
+
+        The lineage of a revision lists every document that inherits it, so
+        its length is bounded by Revision.LINEAGE_LIMIT. Documents in a larger
+        family keep walking the revisions of their ancestors instead.
+
+        """
+        document = cls.get(key)
+        if document is None or document.lineage_indexed or document.deleted:
+            return
+        if cursor is None:
+            if document.family_size() >= Revision.LINEAGE_LIMIT:
+                return
+            cursor = 0, None, 0
+        index, query_cursor, inherited = cursor
+        queries = list(document.inheritance())
+        size = Revision.LINEAGE_BATCH_SIZE
+        while index < len(queries):
+            query = queries[index]
+            if query_cursor:
+                query.with_cursor(query_cursor)
+            keys = query.fetch(size)
+            Revision.update_lineage(keys, add=document)
+            if index:
+                inherited += len(keys)
+            if len(keys) == size:
+                cursor = index, query.cursor(), inherited
+                deferred.defer(cls.index_lineage, key, cursor, count)
+                return
+            index, query_cursor = index + 1, None
+        def txn():
+            document = cls.get(key)
+            if document is None or document.lineage_indexed:
+                return
+            document.lineage_indexed = True
+            if count:
+                document.inherited_revisions = inherited
+                document.counted = True
+            db.Model.put(document)
+        db.run_in_transaction(txn)
+        pastedown.fragment.invalidate(key)
+
+    def inheritance(self):
+        """Yields keys-only queries of the revisions written in the document
+        and then of those it inherits from each ancestor, newest first.
+        Unlike RevisionSet.walk_hierarchy() they do not depend on which
+        documents have their lineage indexed, so a cursor into them stays
+        valid while other forks are indexed.
+
+        """
+        document, before = self, None
+        while document:
+            revisions = Revision.all(keys_only=True) \
+                                .filter("document =", document)
+            if before:
+                revisions.filter("created_at <=", before)
+            yield revisions.order("-created_at")
+            revision = document.parent_revision
+            document = document.parent_document
+            if document and revision:
+                before = revision.created_at
+
+    def family_size(self):
+        """Returns the number of documents that share the oldest revision of
+        its root document, which is the longest lineage in its family.
+
+        """
+        root = self
+        while root.parent_document:
+            root = root.parent_document
+        oldest = Revision.all().filter("document =", root) \
+                               .order("created_at").get()
+        return oldest and len(oldest.lineage) or 0
+
     def delete(self):
-        for fork in self.forks:
-            fork.parent_document = fork.parent_revision = None
-            fork.put()
-        return db.Model.delete(self)
+        """Deletes the document. It is hidden at once as if it were never
+        written, and then purge() detaches its forks and deletes its revisions
+        in batches in the background. Unlike a key_name just claimed, it is
+        marked deleted, so no revision can be written in it any more.
+
+        """
+        def txn():
+            document = Document.get(self.key())
+            if document is not None:
+                document.updated_at = None
+                document.deleted = True
+                db.Model.put(document)
+        db.run_in_transaction(txn)
+        self.updated_at = None
+        self.deleted = True
+        RecentDocuments.remove(self.key().name())
+        deferred.defer(pastedown.search.index_document, self.key().name())
+        deferred.defer(Document.purge, self.key())
+
+    @classmethod
+    def purge(cls, key, step=0, cursor=None):
+        """Runs the steps of PURGE_STEPS for the hidden document of the key
+        and then deletes it. When a step has more than a batch to do, the rest
+        is deferred with the cursor, so the purge resumes from there.
+
+        """
+        document = cls.get(key)
+        if document is None:
+            return
+        while step < len(cls.PURGE_STEPS):
+            purge_step = getattr(document, "purge_" + cls.PURGE_STEPS[step])
+            cursor = purge_step(cursor)
+            if cursor:
+                deferred.defer(cls.purge, key, step, cursor)
+                return
+            step += 1
+        parent = Document.parent_document.get_value_for_datastore(document)
+        if parent:
+            pastedown.counter.increment("forks:%s" % parent, -1)
+        pastedown.counter.delete("revisions:%s" % key)
+        pastedown.counter.delete("forks:%s" % key)
+        db.Model.delete(document)
+        pastedown.fragment.invalidate(key, parent)
+
+    def purge_forks(self, cursor=None):
+        """Detaches a batch of forks from the document. Returns the cursor of
+        the next batch, or None when it is done.
+
+        """
+        query = Document.all(keys_only=True) \
+                        .filter("parent_document =", self.key())
+        if cursor:
+            query.with_cursor(cursor)
+        forks = query.fetch(self.PURGE_BATCH_SIZE)
+        for key in forks:
+            db.run_in_transaction(Document.detach, key)
+        pastedown.fragment.invalidate(*forks)
+        if len(forks) == self.PURGE_BATCH_SIZE:
+            return query.cursor()
+
+    @classmethod
+    def detach(cls, key):
+        """Detaches the document of the key from its parent. Run it in a
+        transaction, so that a revision written in the fork meanwhile is not
+        overwritten.
+
+        """
+        document = cls.get(key)
+        if document is not None:
+            document.parent_document = document.parent_revision = None
+            db.Model.put(document)
+
+    def purge_lineage(self, cursor=None):
+        """Removes the document and its descendants from the lineage of the
+        revisions in its history, a batch at a time, and then recounts the
+        revisions that each descendant inherits. The descendants are found
+        before anything is changed and carried in the cursor, and counts are
+        recounted rather than subtracted, so a retried batch does no harm.
+        Returns the cursor of the next batch, or None when it is done.
+
+        """
+        if cursor is None:
+            return self.find_descendants(), 0, None, 0
+        descendants, index, query_cursor, recounted = cursor
+        removed = descendants + [self.key()]
+        queries = list(RevisionSet.walk_hierarchy(self, keys_only=True))
+        if index < len(queries):
+            query = queries[index]
+            if query_cursor:
+                query.with_cursor(query_cursor)
+            keys = query.fetch(self.PURGE_BATCH_SIZE)
+            Revision.update_lineage(keys, remove=removed)
+            if len(keys) == self.PURGE_BATCH_SIZE:
+                return descendants, index, query.cursor(), recounted
+            return descendants, index + 1, None, recounted
+        batch = descendants[recounted:recounted + self.PURGE_BATCH_SIZE]
+        for key in batch:
+            db.run_in_transaction(Document.recount_inherited, key,
+                                  Document.count_inherited(key))
+        pastedown.fragment.invalidate(*batch)
+        recounted += len(batch)
+        if recounted < len(descendants):
+            return descendants, index, None, recounted
+
+    def purge_revisions(self, cursor=None):
+        """Deletes a batch of revisions written in the document. Returns the
+        cursor of the next batch, or None when it is done.
+
+        """
+        query = Revision.all().filter("document =", self.key())
+        if cursor:
+            query.with_cursor(cursor)
+        revisions = query.fetch(self.PURGE_BATCH_SIZE)
+        db.delete(revisions)
+        # references are released after the revisions are gone, so a failure
+        # between them leaves a content unreleased rather than missing
+        Content.release([revision.digest for revision in revisions
+                         if revision.digest and revision.delta is None])
+        if len(revisions) == self.PURGE_BATCH_SIZE:
+            return query.cursor()
+
+    def find_descendants(self):
+        """Returns keys of the documents forked from the document, directly
+        or not. They fork at or after the oldest revision of the document
+        itself, so the lineage of that revision lists exactly them.
+
+        """
+        oldest = Revision.all().filter("document =", self) \
+                               .order("created_at").get()
+        if oldest is None:
+            return []
+        return [key for key in oldest.lineage if key != self.key()]
+
+    @staticmethod
+    def count_inherited(key):
+        """Counts the revisions in the lineage of the document of the key
+        that it did not write itself.
+
+        """
+        total = Revision.all(keys_only=True).filter("lineage =", key) \
+                                            .count(None)
+        own = Revision.all(keys_only=True).filter("document =", key) \
+                                          .count(None)
+        return max(total - own, 0)
+
+    @classmethod
+    def recount_inherited(cls, key, count):
+        """Sets the number of revisions the document of the key inherits.
+        Run it in a transaction.
+
+        """
+        document = cls.get(key)
+        if document and document.inherited_revisions != count:
+            document.inherited_revisions = count
+            db.Model.put(document)
 
     def __unicode__(self):
         return self.title or u""
@@ -160,27 +531,148 @@ class Revision(db.Model):
     """Document revisions."""
 
     UNTITLED = "(Untitled)"
+    LINEAGE_BATCH_SIZE = 100
+    # every key in a lineage is a row of each index on it, and an entity can
+    # have at most 5000 index rows
+    LINEAGE_LIMIT = 1000
 
     document = db.ReferenceProperty(Document, required=True,
                                     collection_name="overriding_revisions",
                                     indexed=True)
-    body = db.TextProperty(required=True)
+    stored_body = db.TextProperty(name="body")
+    digest = db.StringProperty(indexed=False)
+    delta = db.TextProperty()
+    chain = db.ListProperty(db.Key, indexed=False)
     created_at = db.DateTimeProperty(required=True, auto_now_add=True)
+    cached_title = db.TextProperty(name="title")
+    lineage = db.ListProperty(db.Key)
+
+    def __init__(self, *args, **kwargs):
+        if not kwargs.get("_from_entity", False) and "body" in kwargs:
+            kwargs["stored_body"] = kwargs.pop("body")
+        db.Model.__init__(self, *args, **kwargs)
+
+    @classmethod
+    def update_lineage(cls, keys, add=None, remove=()):
+        """Adds a document to and removes documents from the lineage of the
+        revisions of the keys. Revisions are updated in a transaction per
+        entity group, so concurrent forks do not lose their entries. Returns
+        a dict of how many revisions each removed document was removed from.
+
+        """
+        add = add and add.key()
+        remove = frozenset(remove)
+        groups = {}
+        for key in keys:
+            groups.setdefault(key.parent(), []).append(key)
+        def update(keys):
+            changed = []
+            removed = {}
+            for revision in db.get(keys):
+                if revision is None:
+                    continue
+                lineage = []
+                for k in revision.lineage:
+                    if k in remove:
+                        removed[k] = removed.get(k, 0) + 1
+                    else:
+                        lineage.append(k)
+                if add and add not in lineage:
+                    lineage.append(add)
+                if lineage != revision.lineage:
+                    revision.lineage = lineage
+                    changed.append(revision)
+            db.put(changed)
+            return removed
+        size = cls.LINEAGE_BATCH_SIZE
+        removed = {}
+        for group in groups.itervalues():
+            for i in xrange(0, len(group), size):
+                counts = db.run_in_transaction(update, group[i:i + size])
+                for k, count in counts.iteritems():
+                    removed[k] = removed.get(k, 0) + count
+        return removed
+
+    def body(self):
+        """Body string of the revision. Bodies are stored once per content
+        by their digests, and a revision stored as a delta is rebuilt from
+        the snapshot and the deltas in its chain, which are fetched at once.
+        Revisions written before either keep their body in themselves.
+
+        """
+        if self.stored_body is not None or \
+           self.digest is None and self.delta is None:
+            return self.stored_body
+        try:
+            return self._body
+        except AttributeError:
+            pass
+        key = self.digest or self.key()
+        body = BODY_CACHE.get(key)
+        if body is None:
+            if self.delta is None:
+                body = Content.get_by_key_name(self.digest).text
+            else:
+                revisions = db.get(self.chain)
+                body = revisions[0].body
+                for revision in revisions[1:] + [self]:
+                    body = pastedown.delta.patch(body, revision.delta)
+            BODY_CACHE.set(key, body)
+        self._body = body
+        return body
+
+    def set_body(self, body):
+        self.stored_body = body
+        self.digest = self.delta = None
+        self.chain = []
+        self.__dict__.pop("_body", None)
+
+    body = property(fget=body, fset=set_body)
+    del set_body
 
     @property
     def author(self):
         """Returns the author."""
-        return (self.parent() or self.document).author
+        return self.owner.author
+
+    @property
+    def owner(self):
+        """The document that the revision is written in. It is the same as
+        its document except revisions written before they had a parent.
+
+        """
+        key = self.parent_key()
+        document = Revision.document.get_value_for_datastore(self)
+        if key is None or key == document:
+            return self.document
+        return self.parent()
 
     @property
     def html(self):
-        """Returns the HTML string of its body."""
-        return self.body and MARKDOWN.convert(self.body)
+        """Returns the HTML string of its body. Revisions never change after
+        they are written, so the rendered HTML is cached by the revision key.
+
+        """
+        if not self.body:
+            return self.body
+        elif not self.is_saved():
+            return render_html(self.body)
+        key = self.digest or self.key()
+        html = HTML_CACHE.get(key)
+        if html is None:
+            html = render_html(self.body)
+            HTML_CACHE.set(key, html)
+        return html
 
     @property
     def title(self):
-        """Title of the document."""
-        return create_title(self.html) or self.UNTITLED
+        """Title of the document. It is stored when the revision is written;
+        only revisions written before that fall back to rendering.
+
+        """
+        if self.cached_title is None:
+            return create_title(self.html) or self.UNTITLED
+        return self.cached_title or self.UNTITLED
 
     def fork(self, author, body):
         """Forks the document from this revision."""
@@ -196,13 +688,84 @@ class Revision(db.Model):
         """Returns forked documents."""
         return Document.all().filter("parent_revision =", self)
 
+    def compress(self):
+        """Stores the body as a delta against the current revision of its
+        document. It keeps the full body as a snapshot when the document has
+        no revision of its own yet, when the chain of deltas would reach the
+        snapshot interval, or when the delta is not smaller than the body.
+
+        """
+        owner = self.parent_key()
+        base = Document.cached_revision.get_value_for_datastore(self.document)
+        if owner is None or base is None or base.parent() != owner:
+            return
+        base = db.get(base)
+        interval = REVISION_STORAGE["snapshot_interval"]
+        if base is None or len(base.chain) + 1 >= interval:
+            return
+        body = self.stored_body
+        delta = pastedown.delta.diff(base.body, body)
+        if len(delta) >= len(body):
+            return
+        self.chain = base.chain + [base.key()]
+        self.delta = db.Text(delta)
+
+    def store_body(self):
+        """Moves the body of the new revision out of the entity, into a
+        delta if compress() makes one, or else into the content of its
+        digest, which identical bodies share. When too many writers contend
+        for the same content, the body is kept in the revision itself rather
+        than failing the write.
+
+        """
+        body = self.stored_body
+        if not body:
+            raise db.BadValueError("Property body is required")
+        self.digest = Content.create_digest(body)
+        if REVISION_STORAGE["deltas"]:
+            self.compress()
+        if self.delta is None:
+            try:
+                Content.acquire(body)
+            except db.TransactionFailedError:
+                self.digest = None
+                return
+        self.stored_body = None
+        self._body = body
+
     def put(self):
+        if not self.is_saved():
+            self.store_body()
+        document = Revision.document.get_value_for_datastore(self)
+        if document not in self.lineage:
+            self.lineage.append(document)
+        if self.cached_title is None:
+            self.cached_title = extract_title(self.body) or u""
         def put_it():
-            doc = self.document
+            doc = Document.get(document)
+            if doc is None or doc.deleted:
+                raise DeletedDocumentError("%s is deleted" % document.name())
+            db.Model.put(self)
             doc.updated_at = self.created_at
+            doc.cached_title = self.cached_title
+            doc.cached_revision = self
             doc.put(True)
-            db.Model.put(self)
-        db.run_in_transaction(put_it)
+        try:
+            db.run_in_transaction(put_it)
+        except DeletedDocumentError:
+            if self.digest and self.delta is None:
+                Content.release([self.digest])
+            raise
+        self.document.updated_at = self.created_at
+        self.document.cached_title = self.cached_title
+        self.document.cached_revision = self
+        pastedown.counter.increment("revisions:%s" % document)
+        parent = Document.parent_document \
+                         .get_value_for_datastore(self.document)
+        # the parent lists the title of the document
+        pastedown.fragment.invalidate(document, parent)
+        RecentDocuments.push(self.document)
+        deferred.defer(pastedown.search.index_document, document.name())
         return self.key()
 
     def __unicode__(self):
@@ -233,13 +796,26 @@ class RevisionSet(object):
         self.limit = limit
 
     def query_hierarchy(self):
-        document = self.document
-        before = None
+        return self.walk_hierarchy(self.document)
+
+    @staticmethod
+    def walk_hierarchy(document, before=None, keys_only=False):
+        """Yields queries of revisions of the document and its ancestors,
+        newest first. A document whose lineage is indexed needs only one
+        query for its whole inherited history.
+
+        """
         while document:
-            revisions = document.overriding_revisions
+            revisions = Revision.all(keys_only=keys_only)
+            if document.lineage_indexed:
+                revisions.filter("lineage =", document)
+            else:
+                revisions.filter("document =", document)
             if before:
-                revisions = revisions.filter("created_at <=", before)
+                revisions.filter("created_at <=", before)
             yield revisions.order("-created_at")
+            if document.lineage_indexed:
+                break
             revision = document.parent_revision
             document = document.parent_document
             if document and revision:
@@ -252,9 +828,15 @@ class RevisionSet(object):
             limit = self.limit
         elif self.limit is not None:
             limit = min(self.limit, limit)
-        limit += self.offset
-        if limit is not None and limit <= 0:
-            return 0
+        if limit is not None:
+            limit += self.offset
+            if limit <= 0:
+                return 0
+        if self.document.counted:
+            cnt = self.document.revision_count
+            if limit is not None:
+                cnt = min(cnt, limit)
+            return max(cnt - self.offset, 0)
         for revision_set in self.query_hierarchy():
             cnt += revision_set.count(limit or 1000)
             if limit is not None and limit - cnt <= 0:
@@ -267,6 +849,37 @@ class RevisionSet(object):
             limit = min(self.limit - offset, limit)
         return type(self)(self.document, limit, self.offset + offset)
 
+    def page(self, size, token=None):
+        """Returns a page of revisions, newest first, and the opaque token of
+        the next page, which is None for the last page. The token holds the
+        position in the fork hierarchy and the datastore cursor there, so any
+        page costs as much as the first one. Raises ValueError when the token
+        is invalid.
+
+        """
+        index, cursor = 0, None
+        if token:
+            try:
+                index, cursor = base64.urlsafe_b64decode(str(token)) \
+                                      .split(":", 1)
+                index = int(index)
+            except (TypeError, ValueError):
+                raise ValueError("invalid page token: %r" % token)
+        revisions = []
+        for i, query in enumerate(self.query_hierarchy()):
+            if i < index:
+                continue
+            try:
+                if i == index and cursor:
+                    query.with_cursor(cursor)
+                revisions.extend(query.fetch(size - len(revisions)))
+            except (db.BadValueError, db.BadRequestError):
+                raise ValueError("invalid page token: %r" % token)
+            if len(revisions) >= size:
+                token = "%d:%s" % (i, query.cursor())
+                return revisions, base64.urlsafe_b64encode(token)
+        return revisions, None
+
     def __getitem__(self, key):
         """Finds the revision by the created time or the offset number."""
         if isinstance(key, (datetime.datetime, datetime.date)):
@@ -309,34 +922,423 @@ class RevisionSet(object):
         return self.count()
 
 
+class Content(db.Model):
+    """Revision bodies keyed by their SHA-256 digests. Each is stored once
+    and counts the revisions referencing it, so it is deleted when the last
+    of them is.
+
+    """
+
+    text = db.TextProperty()
+    references = db.IntegerProperty(default=0, indexed=False)
+
+    @staticmethod
+    def create_digest(text):
+        """Returns the digest of the text, which is its key name."""
+        return "sha256:" + hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    @classmethod
+    def acquire(cls, text):
+        """Stores the text unless it is stored already, and counts a
+        reference to it. Returns the digest.
+
+        """
+        digest = cls.create_digest(text)
+        def txn():
+            content = cls.get_by_key_name(digest)
+            if content is None:
+                content = cls(key_name=digest, text=text)
+            content.references += 1
+            content.put()
+        db.run_in_transaction(txn)
+        return digest
+
+    @classmethod
+    def release(cls, digests):
+        """Removes a reference to the content of each digest, and deletes
+        contents no longer referenced.
+
+        """
+        counts = {}
+        for digest in digests:
+            counts[digest] = counts.get(digest, 0) + 1
+        def txn(digest, count):
+            content = cls.get_by_key_name(digest)
+            if content is None:
+                return
+            content.references -= count
+            if content.references > 0:
+                content.put()
+            else:
+                content.delete()
+        for digest, count in counts.iteritems():
+            db.run_in_transaction(txn, digest, count)
+
+
+class RecentDocuments(db.Model):
+    """The capped list of recently updated documents, which the home page
+    reads by one get. Entries are JSON objects that have the key name, title,
+    author name and nick and update time of documents, newest first.
+    Removed documents leave tombstones, a JSON object of their removal times
+    by their key names, of which the newest TOMBSTONES are kept.
+
+    """
+
+    KEY_NAME = "recent"
+    SIZE = 10
+    TOMBSTONES = 100
+
+    entries = db.TextProperty()
+    tombstones = db.TextProperty()
+
+    @classmethod
+    def get_entries(cls):
+        """Returns the list of entries."""
+        feed = cls.get_by_key_name(cls.KEY_NAME)
+        return feed and feed.load() or []
+
+    @classmethod
+    def make_entry(cls, document):
+        """Makes the entry of the document. Its author is found by
+        find_person(), so prefetch_authors() saves lookups of many.
+
+        """
+        name = Document.author.get_value_for_datastore(document)
+        author = name and find_person(name)
+        return {"key_name": document.key().name(),
+                "title": document.title,
+                "author_name": author and author.name,
+                "author_nick": author and author.nick,
+                "updated_at": document.updated_at.isoformat()}
+
+    @classmethod
+    def push(cls, document):
+        """Puts the document on the top of the list in the background, so
+        writing a revision neither contends for the list nor waits for VLAAH
+        to find its author.
+
+        """
+        deferred.defer(cls.refresh, document.key())
+
+    @classmethod
+    def refresh(cls, key):
+        """Merges the current entry of the document of the key into the
+        list. Updates of the same document that race are merged by their
+        update time, and hidden documents are skipped.
+
+        """
+        document = Document.get(key)
+        if document and document.updated_at and not document.deleted:
+            cls.update([cls.make_entry(document)])
+
+    @classmethod
+    def remove(cls, key_name):
+        """Removes the document of the key name from the list. Its tombstone
+        keeps entries of the document made before, e.g. by an update retried
+        in the background, from being merged back.
+
+        """
+        cls.update([], {key_name: datetime.datetime.now().isoformat()})
+
+    @classmethod
+    def update(cls, entries, tombstones=None):
+        """Merges the entries and the tombstones into the list in a
+        transaction. Only the newest entry of each document is kept, unless
+        it is not newer than the tombstone of the document. When writers
+        contend too much, it is retried in the background rather than failing
+        the write.
+
+        """
+        def txn():
+            feed = cls.get_by_key_name(cls.KEY_NAME)
+            if feed is None:
+                feed = cls(key_name=cls.KEY_NAME)
+            removed = feed.load_tombstones()
+            for key_name, removed_at in (tombstones or {}).iteritems():
+                removed[key_name] = max(removed.get(key_name, ""), removed_at)
+            merged = {}
+            for entry in itertools.chain(feed.load(), entries):
+                key_name = entry["key_name"]
+                if entry["updated_at"] <= removed.get(key_name, ""):
+                    continue
+                elif key_name not in merged or \
+                     merged[key_name]["updated_at"] < entry["updated_at"]:
+                    merged[key_name] = entry
+            merged = sorted(merged.itervalues(),
+                            key=lambda entry: entry["updated_at"],
+                            reverse=True)
+            removed = sorted(removed.iteritems(),
+                             key=lambda item: item[1], reverse=True)
+            feed.entries = db.Text(json.dumps(merged[:cls.SIZE]))
+            feed.tombstones = db.Text(json.dumps(
+                dict(removed[:cls.TOMBSTONES])
+            ))
+            feed.put()
+        try:
+            db.run_in_transaction(txn)
+        except db.TransactionFailedError:
+            deferred.defer(cls.update, entries, tombstones)
+
+    def load(self):
+        """Decodes the entries."""
+        return self.entries and json.loads(self.entries) or []
+
+    def load_tombstones(self):
+        """Decodes the tombstones."""
+        return self.tombstones and json.loads(self.tombstones) or {}
+
+
+class SessionEpoch(db.Model):
+    """The session epoch of a person, keyed by the person name. Signing out
+    bumps it, which revokes every session signed in before.
+
+    """
+
+    MEMCACHE_NAMESPACE = "epoch"
+
+    epoch = db.IntegerProperty(default=0, indexed=False)
+
+
 TITLE_PATTERN = re.compile(ur"<h1(\s[^>]*)?>\s*(?P<title>.+?)\s*</h1>")
 FIRST_SENTENCE_PATTERN = re.compile(ur"^(?:[^?.]|\.[A-Z])+\??")
 TITLE_MAX_LENGTH = 30
 TITLE_ELLIPSIS = u"\u2026"
 
 
+def strip_html(html):
+    """Strips tags of the HTML and decodes its entities."""
+    html = re.sub(ur"<[^>]+>", u"", html)
+    map = htmlentitydefs.name2codepoint
+    return re.sub(
+        ur"&(?:#([0-9a-fA-F]+)|(\w+));",
+        lambda m: unichr(map[m.group(2)] if m.group(2)
+                                         else int(m.group(1), 16)),
+        html
+    )
+
+
+def shorten_title(text):
+    """Cuts the title text down to TITLE_MAX_LENGTH."""
+    if len(text) > TITLE_MAX_LENGTH:
+        length = TITLE_MAX_LENGTH - len(TITLE_ELLIPSIS)
+        text = text[0:length] + TITLE_ELLIPSIS
+    return text or None
+
+
 def create_title(html):
     """Title of the HTML document. It is from its first <h1> text or its first
     some text.
 
     """
-    def strip_html(html):
-        html = re.sub(ur"<[^>]+>", u"", html)
-        map = htmlentitydefs.name2codepoint
-        return re.sub(
-            ur"&(?:#([0-9a-fA-F]+)|(\w+));",
-            lambda m: unichr(map[m.group(2)] if m.group(2)
-                                             else int(m.group(1), 16)),
-            html
-        )
     match = TITLE_PATTERN.search(html)
     if match:
         return strip_html(match.group("title")) or None
     text = strip_html(html)
     match = FIRST_SENTENCE_PATTERN.match(text)
-    text = match.group(0) if match else text
-    if len(text) > TITLE_MAX_LENGTH:
-        length = TITLE_MAX_LENGTH - len(TITLE_ELLIPSIS)
-        text = text[0:length] + TITLE_ELLIPSIS
-    return text or None
+    return shorten_title(match.group(0) if match else text)
+
+
+def create_slug(title):
+    """Makes the URL slug from the title."""
+    title = (title or u"").replace(TITLE_ELLIPSIS, u"")
+    return re.sub(ur"\W+", ur"-", re.sub(ur"^\W+|\W+$", ur"", title)).lower()
+
+
+def render_html(body):
+    """Renders the Markdown body to HTML, the same as MARKDOWN.convert().
+    Blocks are rendered one by one and cached by their source, so a new
+    revision renders only the blocks its edit changed.
+
+    """
+    text = pastedown.markup.normalize(body)
+    if pastedown.markup.is_global(text):
+        return unicode(MARKDOWN.convert(body))
+    text, definitions = pastedown.markup.strip_link_definitions(text)
+    blocks = []
+    start = 0
+    for end in pastedown.markup.blocks(text):
+        block = text[start:end]
+        start = end
+        if block.strip():
+            if definitions and u"[" in block:
+                block = definitions + block
+            blocks.append(block)
+    if not blocks:
+        return unicode(MARKDOWN.convert(body))
+    keys = [hashlib.sha1(block.encode("utf-8")).hexdigest()
+            for block in blocks]
+    cached = BLOCK_CACHE.get_multi(keys)
+    rendered = {}
+    for key, block in itertools.izip(keys, blocks):
+        if key not in cached:
+            html = unicode(MARKDOWN.convert(block)).strip(u"\n")
+            if u"<p><" in html:
+                # markdown2 hashes a tag it generated together with the tags
+                # of following blocks, so this block depends on the rest
+                return unicode(MARKDOWN.convert(body))
+            cached[key] = rendered[key] = html
+    if rendered:
+        BLOCK_CACHE.set_multi(rendered)
+    return u"\n\n".join(cached[key] for key in keys) + u"\n"
+
+
+def extract_title(body):
+    """Title of the Markdown document, the same as create_title() of its
+    HTML. Instead of rendering the whole document, it renders only blocks
+    that may have <h1>, and then only as many leading blocks as needed to
+    find the end of the first sentence.
+
+    """
+    text = pastedown.markup.normalize(body)
+    if pastedown.markup.is_global(text):
+        return create_title(MARKDOWN.convert(body))
+    text, definitions = pastedown.markup.strip_link_definitions(text)
+    def render(part):
+        if definitions and u"[" in part:
+            part += u"\n\n" + definitions
+        return MARKDOWN.convert(part)
+    ends = list(pastedown.markup.blocks(text))
+    start = 0
+    for end in ends:
+        block = text[start:end]
+        if pastedown.markup.may_have_h1(block):
+            match = TITLE_PATTERN.search(render(block))
+            if match:
+                return strip_html(match.group("title")) or None
+        start = end
+    count = 1
+    while count < len(ends):
+        prefix = strip_html(render(text[:ends[count - 1]])).rstrip()
+        match = FIRST_SENTENCE_PATTERN.match(prefix)
+        if match:
+            # the sentence ends inside the prefix or is long enough already
+            if match.end() < len(prefix) or match.end() > TITLE_MAX_LENGTH:
+                return shorten_title(match.group(0))
+        elif len(prefix) > TITLE_MAX_LENGTH:
+            return shorten_title(prefix)
+        count *= 2
+    return create_title(MARKDOWN.convert(body))
+
+
+def find_person(name):
+    """Finds the VLAAH person of the name, e.g. ``~name``. People are cached
+    in the process for a while, so a signed person is not looked up from
+    VLAAH on every request. Returns None when the name is not of a person.
+
+    """
+    person = PEOPLE.get(name)
+    if person is None:
+        person = VLAAH.find(name)
+        if not isinstance(person, vlaah.Person):
+            return None
+        PEOPLE.set(name, person)
+    return person
 
+
+def forget_person(name):
+    """Drops the cached person of the name."""
+    PEOPLE.delete(name)
+
+
+def find_people(names):
+    """Finds VLAAH people of the names. Each distinct name is looked up only
+    once, and cached people are not looked up at all. Returns a dict of found
+    people by their names.
+
+    """
+    people = {}
+    for name in set(names):
+        person = name and find_person(name)
+        if person:
+            people[name] = person
+    return people
+
+
+def prefetch_authors(entities):
+    """Resolves authors of the documents and revisions before they are
+    rendered. Documents of the revisions are fetched by one batch get, and
+    then authors by find_people(). Returns the entities as a list.
+
+    """
+    entities = list(entities)
+    keys = set(entity.parent_key() or
+               Revision.document.get_value_for_datastore(entity)
+               for entity in entities if isinstance(entity, Revision))
+    documents = dict((doc.key(), doc)
+                     for doc in db.get(list(keys)) if doc is not None)
+    owners = []
+    for entity in entities:
+        if isinstance(entity, Revision):
+            key = Revision.document.get_value_for_datastore(entity)
+            if key in documents:
+                entity.document = documents[key]
+            owner = documents.get(entity.parent_key() or key)
+        else:
+            owner = entity
+        owners.append(owner)
+    names = [Document.author.get_value_for_datastore(owner)
+             for owner in owners if owner is not None]
+    people = find_people(names)
+    for owner in owners:
+        if owner is not None:
+            name = Document.author.get_value_for_datastore(owner)
+            if name in people:
+                owner.author = people[name]
+    return entities
+
+
+def find_ticket(person, ticket_id):
+    """Finds the ticket of the person, which is cached the same as people.
+    A cached ticket is validated by VLAAH again once TICKET_VALIDITY seconds
+    passed since it was last, and forgotten as soon as VLAAH rejects it, so
+    an expired ticket is not trusted longer than that. Raises KeyError when
+    the ticket is expired, as person.tickets does.
+
+    """
+    key = person.name, ticket_id
+    ticket, validated_at = TICKETS.get(key, (None, 0))
+    if validated_at + TICKET_VALIDITY <= time.time():
+        try:
+            ticket = person.tickets[ticket_id]
+        except KeyError:
+            forget_ticket(person, ticket_id)
+            raise
+        TICKETS.set(key, (ticket, time.time()))
+    return ticket
+
+
+def forget_ticket(person, ticket_id):
+    """Drops the cached ticket of the person."""
+    TICKETS.delete((person.name, ticket_id))
+
+
+def find_session_epoch(name):
+    """Returns the session epoch of the person of the name. A session is
+    trusted only while it holds the current epoch of its person.
+
+    """
+    ns = SessionEpoch.MEMCACHE_NAMESPACE
+    epoch = memcache.get(name, namespace=ns)
+    if epoch is None:
+        entity = SessionEpoch.get_by_key_name(name)
+        epoch = entity and entity.epoch or 0
+        memcache.add(name, epoch, namespace=ns)
+    return epoch
+
+
+def bump_session_epoch(name):
+    """Moves the person of the name to a new session epoch, so sessions of
+    the person signed in before are no longer trusted. Returns the new
+    epoch.
+
+    """
+    def txn():
+        entity = SessionEpoch.get_by_key_name(name)
+        if entity is None:
+            entity = SessionEpoch(key_name=name)
+        entity.epoch += 1
+        entity.put()
+        return entity.epoch
+    epoch = db.run_in_transaction(txn)
+    memcache.set(name, epoch, namespace=SessionEpoch.MEMCACHE_NAMESPACE)
+    return epoch
@@ -0,0 +1,315 @@
+import re
+import math
+import uuid
+import bisect
+import hashlib
+import datetime
+import itertools
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+from google.appengine.ext import db, deferred
+import pastedown.counter
+import pastedown.model
+
+
+SHARDS = 32
+BLOCK_SIZE = 1000
+MAX_POSTINGS = 100000
+MAX_CANDIDATES = 10000
+BATCH_SIZE = 100
+MAX_TERM_LENGTH = 32
+MAX_QUERY_TERMS = 8
+# longer than a task can run, so a lease never expires under its holder
+LEASE_SECONDS = 60
+TERM_PATTERN = re.compile(r"\w+", re.UNICODE)
+STOP_WORDS = frozenset("""
+    a an and are as at be but by for from has have he her his i if in into is
+    it its me my not of on or our she so that the their them then there these
+    they this to was we were what when which who will with you your
+""".split())
+DOCUMENTS_COUNTER = "search:documents"
+
+
+def tokenize(text):
+    """Returns the list of lowercased terms in the text, except stop
+    words.
+
+    """
+    return [term for term in TERM_PATTERN.findall(text.lower())
+            if 1 < len(term) <= MAX_TERM_LENGTH and term not in STOP_WORDS]
+
+
+def count_terms(text):
+    """Returns a dict of how many times each term occurs in the text."""
+    counts = {}
+    for term in tokenize(text):
+        counts[term] = counts.get(term, 0) + 1
+    return counts
+
+
+def shard_of(key_name):
+    """Returns the posting shard number of the document key name."""
+    digest = hashlib.md5(key_name.encode("utf-8")).hexdigest()
+    return int(digest[:8], 16) % SHARDS
+
+
+class PostingList(db.Model):
+    """A shard of the posting list of a term. Documents are spread over
+    SHARDS shards by their key names, so indexing different documents rarely
+    contends. A shard is split into PostingBlock children by key name
+    ranges, and only lists the lower bound and size of each block, so no
+    entity grows with the number of documents beyond BLOCK_SIZE entries.
+    A shard stops taking documents once it has MAX_POSTINGS of them, and
+    then the term is too common to narrow searches, like a stop word.
+
+    """
+
+    bounds = db.StringListProperty(indexed=False)
+    sizes = db.ListProperty(int, indexed=False)
+    full = db.BooleanProperty(default=False, indexed=False)
+
+    @staticmethod
+    def key_name(term, shard):
+        return u"term:%s:%d" % (term, shard)
+
+    @property
+    def document_count(self):
+        return sum(self.sizes)
+
+    def find_block(self, key_name):
+        """Returns the index of the block whose range has the key name."""
+        return bisect.bisect_right(self.bounds, key_name) - 1
+
+    def block_key(self, index):
+        return db.Key.from_path(PostingBlock.kind(), u"b" + self.bounds[index],
+                                parent=self.key())
+
+    @classmethod
+    def update(cls, term, key_name, frequency):
+        """Sets the frequency of the term in the document of the key name.
+        A zero frequency removes the document. A block that outgrows
+        BLOCK_SIZE is split in half, and an emptied one is deleted. Run it
+        in a transaction.
+
+        """
+        postings = cls.get_by_key_name(cls.key_name(term, shard_of(key_name)))
+        if postings is None:
+            if not frequency:
+                return
+            postings = cls(key_name=cls.key_name(term, shard_of(key_name)),
+                           bounds=[u""], sizes=[0])
+        i = postings.find_block(key_name)
+        block = PostingBlock.get(postings.block_key(i))
+        if block is None:
+            block = PostingBlock(key=postings.block_key(i))
+        j = bisect.bisect_left(block.documents, key_name)
+        if j < len(block.documents) and block.documents[j] == key_name:
+            if frequency:
+                block.frequencies[j] = frequency
+            else:
+                del block.documents[j]
+                del block.frequencies[j]
+        elif frequency and not postings.full:
+            block.documents.insert(j, key_name)
+            block.frequencies.insert(j, frequency)
+        else:
+            return
+        put = [postings, block]
+        if len(block.documents) > BLOCK_SIZE:
+            half = len(block.documents) // 2
+            bound = block.documents[half]
+            postings.bounds.insert(i + 1, bound)
+            postings.sizes.insert(i + 1, len(block.documents) - half)
+            put.append(PostingBlock(key=postings.block_key(i + 1),
+                                    documents=block.documents[half:],
+                                    frequencies=block.frequencies[half:]))
+            del block.documents[half:]
+            del block.frequencies[half:]
+        postings.sizes[i] = len(block.documents)
+        postings.full = postings.full or \
+                        postings.document_count >= MAX_POSTINGS
+        if not postings.document_count:
+            db.delete([postings, block])
+        elif block.documents:
+            db.put(put)
+        else:
+            if i:
+                del postings.bounds[i]
+                del postings.sizes[i]
+            db.put(postings)
+            db.delete(block)
+
+
+class PostingBlock(db.Model):
+    """Key names of documents in a range of a PostingList, sorted, and the
+    frequencies of the term in them.
+
+    """
+
+    documents = db.StringListProperty(indexed=False)
+    frequencies = db.ListProperty(int, indexed=False)
+
+
+class IndexState(db.Model):
+    """Term frequencies of a document as they are indexed, keyed by the
+    document key name, so reindexing writes only the terms that changed.
+    A task indexing the document holds a lease on it, so tasks of the same
+    document never change its postings at the same time.
+
+    """
+
+    terms = db.TextProperty()
+    lease = db.StringProperty(indexed=False)
+    leased_until = db.DateTimeProperty(indexed=False)
+
+    def load(self):
+        """Returns the dict of indexed term frequencies."""
+        return self.terms and json.loads(self.terms) or {}
+
+    @classmethod
+    def acquire(cls, key_name, lease):
+        """Leases the state of the document of the key name for
+        LEASE_SECONDS. Returns the state, or None when another task holds
+        the lease. Run it in a transaction.
+
+        """
+        state = cls.get_by_key_name(key_name) or cls(key_name=key_name)
+        now = datetime.datetime.now()
+        if state.lease and state.leased_until > now:
+            return None
+        state.lease = lease
+        state.leased_until = now + datetime.timedelta(seconds=LEASE_SECONDS)
+        state.put()
+        return state
+
+    @classmethod
+    def release(cls, key_name, lease, terms):
+        """Stores the indexed term frequencies and releases the lease. The
+        state is deleted when no term is indexed. Returns False, storing
+        nothing, when the lease is not held any more. Run it in a
+        transaction.
+
+        """
+        state = cls.get_by_key_name(key_name)
+        if state is None or state.lease != lease:
+            return False
+        if terms:
+            state.terms = db.Text(json.dumps(terms))
+            state.lease = state.leased_until = None
+            state.put()
+        else:
+            state.delete()
+        return True
+
+
+def index_document(key_name):
+    """Updates the postings of the document to its current body, or removes
+    them when it is deleted. Only terms whose frequencies changed since it
+    was indexed are written; when more than BATCH_SIZE changed, the progress
+    is stored and the rest is deferred. While another task indexes the same
+    document, it is deferred until the lease of that task expires.
+
+    """
+    lease = uuid.uuid4().hex
+    state = db.run_in_transaction(IndexState.acquire, key_name, lease)
+    if state is None:
+        deferred.defer(index_document, key_name, _countdown=LEASE_SECONDS)
+        return
+    document = pastedown.model.Document.get_by_key_name(key_name)
+    if document is None or document.updated_at is None:
+        terms = {}
+    else:
+        terms = count_terms(document.body or u"")
+    indexed = state.load()
+    was_indexed = bool(indexed)
+    changed = [term for term in set(terms) | set(indexed)
+               if terms.get(term) != indexed.get(term)]
+    for term in changed[:BATCH_SIZE]:
+        frequency = terms.get(term, 0)
+        db.run_in_transaction(PostingList.update, term, key_name, frequency)
+        if frequency:
+            indexed[term] = frequency
+        else:
+            del indexed[term]
+    if not db.run_in_transaction(IndexState.release, key_name, lease,
+                                 indexed):
+        deferred.defer(index_document, key_name)
+        return
+    if indexed and not was_indexed:
+        pastedown.counter.increment(DOCUMENTS_COUNTER)
+    elif was_indexed and not indexed:
+        pastedown.counter.increment(DOCUMENTS_COUNTER, -1)
+    if len(changed) > BATCH_SIZE:
+        deferred.defer(index_document, key_name)
+
+
+def search(query, limit=20):
+    """Returns key names of the documents that contain every term of the
+    query, ranked by TF-IDF. The posting list shards of all terms are
+    fetched by one batch get. Blocks of the rarest term are read for up to
+    MAX_CANDIDATES candidates, and then of each other term, rarest first,
+    only the blocks that may have the remaining candidates.
+
+    """
+    terms = []
+    for term in tokenize(query):
+        if term not in terms:
+            terms.append(term)
+    terms = terms[:MAX_QUERY_TERMS]
+    if not terms:
+        return []
+    key_names = [PostingList.key_name(term, shard)
+                 for term in terms for shard in xrange(SHARDS)]
+    shards = PostingList.get_by_key_name(key_names)
+    lists = []
+    for i in xrange(len(terms)):
+        postings = shards[i * SHARDS:(i + 1) * SHARDS]
+        if [p for p in postings if p is not None and p.full]:
+            continue
+        count = sum(p.document_count for p in postings if p is not None)
+        if not count:
+            return []
+        lists.append((count, postings))
+    if not lists:
+        return []
+    lists.sort(key=lambda item: item[0])
+    keys = []
+    size = 0
+    for postings in lists[0][1]:
+        for i in xrange(postings and len(postings.bounds) or 0):
+            if size < MAX_CANDIDATES:
+                keys.append(postings.block_key(i))
+                size += postings.sizes[i]
+    candidates = {}
+    for block in db.get(keys):
+        if block is not None:
+            for key_name, frequency in itertools.izip(block.documents,
+                                                      block.frequencies):
+                candidates[key_name] = [frequency]
+    for count, postings in lists[1:]:
+        keys = set()
+        for key_name in candidates:
+            posting = postings[shard_of(key_name)]
+            if posting is not None:
+                keys.add(posting.block_key(posting.find_block(key_name)))
+        matched = {}
+        for block in db.get(list(keys)):
+            if block is not None:
+                for key_name, frequency in itertools.izip(block.documents,
+                                                          block.frequencies):
+                    if key_name in candidates:
+                        candidates[key_name].append(frequency)
+                        matched[key_name] = candidates[key_name]
+        candidates = matched
+        if not candidates:
+            return []
+    total = max(pastedown.counter.get(DOCUMENTS_COUNTER), lists[-1][0])
+    weights = [math.log(1 + float(total) / count) for count, postings in lists]
+    scores = {}
+    for key_name, frequencies in candidates.iteritems():
+        scores[key_name] = sum((1 + math.log(frequency)) * weight
+                               for frequency, weight
+                               in itertools.izip(frequencies, weights))
+    return sorted(scores, key=scores.get, reverse=True)[:limit]
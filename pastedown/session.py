@@ -0,0 +1,214 @@
+import os
+import hmac
+import time
+import base64
+import hashlib
+import Cookie
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+from google.appengine.ext import db
+import pastedown
+
+
+def equals(a, b):
+    """Compares the strings in time that does not depend on where they
+    differ, so signatures cannot be guessed byte by byte.
+
+    """
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+
+class CookieStore(object):
+    """Keeps the session data in the cookie itself, signed by HMAC-SHA1 of
+    the secret, so it costs no RPC. Fits small data like a person name and
+    a ticket id. Signed data older than MAX_AGE seconds is dropped.
+
+    A signed cookie stays valid until it expires even after it is deleted
+    from the browser, so whatever it grants must be checked again, e.g. by
+    the session epoch of its person.
+
+    """
+
+    MAX_AGE = 7 * 24 * 60 * 60
+
+    def __init__(self, secret):
+        self.secret = secret
+
+    def sign(self, payload):
+        return hmac.new(self.secret, payload, hashlib.sha1).hexdigest()
+
+    def load(self, value):
+        """Returns the data of the cookie value. An empty dict when it is
+        forged, expired or malformed.
+
+        """
+        payload, _, signature = value.rpartition(".")
+        if not equals(signature, self.sign(payload)):
+            return {}
+        try:
+            data = json.loads(base64.urlsafe_b64decode(payload))
+        except (TypeError, ValueError):
+            return {}
+        if not isinstance(data, dict) or \
+           data.get("time", 0) + self.MAX_AGE < time.time():
+            return {}
+        return data.get("data", {})
+
+    def save(self, value, data):
+        """Returns the cookie value holding the data."""
+        payload = json.dumps({"data": data, "time": int(time.time())})
+        payload = base64.urlsafe_b64encode(payload)
+        return "%s.%s" % (payload, self.sign(payload))
+
+    def delete(self, value):
+        pass
+
+
+class SessionData(db.Model):
+    """Session data stored by DatastoreStore, keyed by the session id."""
+
+    data = db.TextProperty()
+
+
+class DatastoreStore(object):
+    """Keeps the session data in the datastore, and only its random id in
+    the cookie.
+
+    """
+
+    ID_LENGTH = 32
+
+    def __init__(self, secret=None):
+        pass
+
+    def load(self, value):
+        if len(value) != self.ID_LENGTH:
+            return {}
+        entity = SessionData.get_by_key_name("s" + value)
+        return entity and json.loads(entity.data) or {}
+
+    def save(self, value, data):
+        value = value or base64.urlsafe_b64encode(os.urandom(24))
+        SessionData(key_name="s" + value, data=json.dumps(data)).put()
+        return value
+
+    def delete(self, value):
+        db.delete(db.Key.from_path(SessionData.kind(), "s" + value))
+
+
+STORES = {"cookie": CookieStore, "datastore": DatastoreStore}
+
+
+class Session(object):
+    """Dict-like session. The cookie is read on the first access, and the
+    session is saved only when its data changed. Visitors who have never
+    stored anything have no session at all.
+
+    """
+
+    def __init__(self, store, value=None):
+        self.store = store
+        self.value = value
+        self.dirty = False
+
+    @property
+    def data(self):
+        try:
+            return self._data
+        except AttributeError:
+            self._data = self.value and self.store.load(self.value) or {}
+            return self._data
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def pop(self, key, default=None):
+        if key in self.data:
+            self.dirty = True
+        return self.data.pop(key, default)
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        if key not in self.data or self.data[key] != value:
+            self.data[key] = value
+            self.dirty = True
+
+    def __delitem__(self, key):
+        del self.data[key]
+        self.dirty = True
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def save(self):
+        """Saves the changed session. Returns the new cookie value, or None
+        when the session became empty and the cookie should be deleted.
+
+        """
+        if self.data:
+            self.value = self.store.save(self.value, self.data)
+            return self.value
+        elif self.value:
+            self.store.delete(self.value)
+        self.value = None
+
+
+def settings():
+    """Reads the optional ``[session]`` section, whose ``store`` is either
+    ``cookie`` (default) or ``datastore``. The cookie is sent only over
+    HTTPS while ``secure`` is on, which it is by default except on the
+    development server.
+
+    """
+    config = pastedown.configuration("session", optional=True)
+    development = os.environ.get("SERVER_SOFTWARE", "") \
+                            .startswith("Development")
+    secure = config.get("secure", "off" if development else "on")
+    return {"store": STORES[config.get("store", "cookie")],
+            "secure": secure.lower() in ("1", "yes", "true", "on")}
+
+
+class SessionMiddleware(object):
+    """WSGI middleware that puts a lazy Session into
+    ``environ["pastedown.session"]`` and sets its cookie only when it
+    changed.
+
+    """
+
+    def __init__(self, application, secret, key="pastedown_session",
+                 store=CookieStore, secure=False):
+        self.application = application
+        self.store = store(secret)
+        self.key = key
+        self.secure = secure
+
+    def __call__(self, environ, start_response):
+        cookie = Cookie.SimpleCookie()
+        try:
+            cookie.load(environ.get("HTTP_COOKIE", ""))
+        except Cookie.CookieError:
+            pass
+        value = self.key in cookie and cookie[self.key].value or None
+        session = environ["pastedown.session"] = Session(self.store, value)
+        def session_start_response(status, headers, exc_info=None):
+            if session.dirty:
+                value = session.save()
+                if value:
+                    header = "%s=%s; Path=/; HttpOnly" % (self.key, value)
+                    if self.secure:
+                        header += "; Secure"
+                else:
+                    header = "%s=; Path=/; Expires=Thu, 01 Jan 1970 " \
+                             "00:00:00 GMT" % self.key
+                headers = headers + [("Set-Cookie", header)]
+            return start_response(status, headers, exc_info)
+        return self.application(environ, session_start_response)
@@ -4,12 +4,31 @@ import jinja2
 import vlaah
 from recaptcha.client import captcha
 import pastedown
+import pastedown.fragment
 from pastedown.model import *
 
 
 PATH = os.path.join(os.path.dirname(__file__), "views")
-LOADER = jinja2.FileSystemLoader(PATH)
-ENVIRONMENT = jinja2.Environment(loader=LOADER)
+COMPILED_PATH = os.path.join(os.path.dirname(__file__), "views_compiled")
+
+
+def create_loader():
+    """Creates the template loader. Templates precompiled by
+    ``setup.py compile_templates`` are loaded from COMPILED_PATH if it
+    exists, except on the development server, where templates change.
+
+    """
+    server = os.environ.get("SERVER_SOFTWARE", "")
+    if os.path.isdir(COMPILED_PATH) and not server.startswith("Development"):
+        return jinja2.ModuleLoader(COMPILED_PATH)
+    return jinja2.FileSystemLoader(PATH)
+
+
+LOADER = create_loader()
+ENVIRONMENT = jinja2.Environment(
+    loader=LOADER,
+    extensions=[pastedown.fragment.FragmentCacheExtension]
+)
 
 
 def global_(function):
@@ -3,6 +3,7 @@ from distutils.cmd import Command
 from distutils.errors import DistutilsOptionError
 import os
 import os.path
+import sys
 import tarfile
 import urllib2
 import hashlib
@@ -76,9 +77,54 @@ class download_libs(Command):
             self.install_external_lib(name, url)
 
 
+class compile_templates(Command):
+    """Precompile Jinja2 templates into Python modules."""
+
+    path = os.path.join("pastedown", "views")
+    target = os.path.join("pastedown", "views_compiled")
+    sdk = os.environ.get("GAE_SDK", "/usr/local/google_appengine")
+    # filters of pastedown.template, which imports the whole application;
+    # only their names are checked at compile time
+    filters = "url", "remove_query"
+    extensions = ["pastedown.fragment.FragmentCacheExtension"]
+    description = __doc__
+    user_options = [("target=", "t", "the directory to store compiled "
+                                     "templates (default: %s)" % target),
+                    ("sdk=", "s", "the path to Google App Engine SDK, which "
+                                  "template extensions import "
+                                  "(default: %s)" % sdk)]
+
+    def initialize_options(self):
+        pass
+
+    def finalize_options(self):
+        if not os.path.isdir(self.path):
+            raise DistutilsOptionError, "%r does not exist" % self.path
+
+    def run(self):
+        sys.path[:0] = [self.sdk, os.path.dirname(os.path.abspath(__file__))]
+        import jinja2
+        environment = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(self.path),
+            extensions=self.extensions
+        )
+        environment.filters.update((name, lambda value, *args: value)
+                                   for name in self.filters)
+        if not os.path.isdir(self.target):
+            os.mkdir(self.target)
+        environment.compile_templates(
+            self.target,
+            filter_func=lambda name: name.endswith(".html"),
+            zip=None,
+            log_function=self.announce,
+            ignore_errors=False
+        )
+
+
 setup(name="pastedown",
       packages=["pastedown"],
       package_dir={"pastedown": "pastedown"},
       url="http://pastedown.lunant.net/",
-      cmdclass={"download_libs": download_libs})
+      cmdclass={"download_libs": download_libs,
+                "compile_templates": compile_templates})
 
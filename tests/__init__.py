@@ -0,0 +1,155 @@
+"""Tests of Pastedown. They run against the in-memory API stubs of the App
+Engine SDK, which is found in ``$GAE_SDK`` or /usr/local/google_appengine,
+and a fake VLAAH session that makes people up instead of calling the API::
+
+    pastedown$ python -m unittest discover
+
+"""
+import os
+import os.path
+import sys
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup_environment(sdk):
+    """Sets up the App Engine SDK and in-memory API stubs."""
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, ROOT)
+    os.environ.update(APPLICATION_ID="pastedown",
+                      AUTH_DOMAIN="gmail.com",
+                      CURRENT_VERSION_ID="test.1",
+                      SERVER_SOFTWARE="Development/1.0")
+    from google.appengine.api import apiproxy_stub_map, datastore_file_stub, \
+                                     urlfetch_stub, user_service_stub
+    from google.appengine.api.memcache import memcache_stub
+    try:
+        from google.appengine.api.taskqueue import taskqueue_stub
+    except ImportError:
+        from google.appengine.api.labs.taskqueue import taskqueue_stub
+    apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+    stubs = [
+        ("datastore_v3",
+         datastore_file_stub.DatastoreFileStub("pastedown", None, None)),
+        ("memcache", memcache_stub.MemcacheServiceStub()),
+        ("taskqueue", taskqueue_stub.TaskQueueServiceStub(root_path=ROOT)),
+        ("urlfetch", urlfetch_stub.URLFetchServiceStub()),
+        ("user", user_service_stub.UserServiceStub())
+    ]
+    for name, stub in stubs:
+        apiproxy_stub_map.apiproxy.RegisterStub(name, stub)
+
+
+def install_fake_vlaah():
+    """Injects a VLAAH session that makes people up instead of calling the
+    API. It must run before pastedown.model is imported. Returns the
+    session.
+
+    """
+    import vlaah
+    import pastedown
+
+    class FakePerson(vlaah.Person):
+
+        def __init__(self, name):
+            self._name = name
+
+        name = property(lambda self: self._name)
+        normal_name = property(lambda self: self._name.lower())
+        nick = property(lambda self: self._name.lstrip("~"))
+        picture_url = property(lambda self: "/etc/images/vlaah.png")
+
+    class FakeSession(vlaah.Session):
+
+        appkey = "test"
+
+        def find(self, name):
+            if name and name.startswith("~"):
+                return FakePerson(name)
+
+    pastedown.VLAAH = FakeSession()
+    return pastedown.VLAAH
+
+
+def use_sample_configuration():
+    """Reads pastedown/config.ini.dist instead of config.ini, so tests do
+    not depend on the local configuration.
+
+    """
+    import pastedown
+    pastedown.CONFIG_FILE = os.path.join(ROOT, "pastedown", "config.ini.dist")
+
+
+def request(method, path, body="", headers=None, application=None):
+    """Requests the path from the application, pastedown.app.application by
+    default. Returns the status code, a dict of the response headers and the
+    response body.
+
+    """
+    import wsgiref.util
+    import StringIO
+    import pastedown.app
+    if application is None:
+        application = pastedown.app.application
+    environ = {"REQUEST_METHOD": method, "PATH_INFO": path,
+               "CONTENT_TYPE": "application/x-www-form-urlencoded",
+               "CONTENT_LENGTH": str(len(body)),
+               "wsgi.input": StringIO.StringIO(body)}
+    for name, value in (headers or {}).iteritems():
+        name = name.upper().replace("-", "_")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = "HTTP_" + name
+        environ[name] = value
+    wsgiref.util.setup_testing_defaults(environ)
+    response = []
+    def start_response(status, headers, exc_info=None):
+        response.append((int(status.split()[0]), dict(headers)))
+    body = "".join(application(environ, start_response))
+    status, headers = response[0]
+    return status, headers, body
+
+
+def clear():
+    """Empties the datastore, memcache, the task queue and the
+    process-local caches, so that each test starts afresh.
+
+    """
+    from google.appengine.api import apiproxy_stub_map, memcache
+    import pastedown.cache
+    import pastedown.model
+    apiproxy_stub_map.apiproxy.GetStub("datastore_v3").Clear()
+    apiproxy_stub_map.apiproxy.GetStub("taskqueue").FlushQueue("default")
+    memcache.flush_all()
+    for value in vars(pastedown.model).itervalues():
+        if isinstance(value, pastedown.cache.Cache):
+            value.local.clear()
+        elif isinstance(value, pastedown.cache.LRUCache):
+            value.clear()
+
+
+def run_tasks():
+    """Runs the deferred tasks on the task queue, and then the tasks they
+    defer, until the queue is empty. Returns how many tasks ran.
+
+    """
+    import base64
+    from google.appengine.api import apiproxy_stub_map
+    from google.appengine.ext import deferred
+    stub = apiproxy_stub_map.apiproxy.GetStub("taskqueue")
+    ran = 0
+    while True:
+        tasks = stub.GetTasks("default")
+        if not tasks:
+            return ran
+        stub.FlushQueue("default")
+        for task in tasks:
+            deferred.run(base64.b64decode(task["body"]))
+            ran += 1
+
+
+setup_environment(os.environ.get("GAE_SDK", "/usr/local/google_appengine"))
+VLAAH = install_fake_vlaah()
+use_sample_configuration()
@@ -0,0 +1,152 @@
+import unittest
+import tests  # sets up the API stubs and VLAAH before pastedown
+from google.appengine.ext import webapp
+from pastedown.appext import WSGIApplication
+from pastedown.model import Document
+
+
+class ConditionalGetTest(unittest.TestCase):
+
+    def setUp(self):
+        tests.clear()
+        self.document = Document(author=None, body=u"# Hello\n\nWorld.")
+        self.document.put()
+        self.path = "/" + self.document.key().name()
+
+    def get(self, accept, path=None, **headers):
+        headers = dict((name.replace("_", "-"), value)
+                       for name, value in headers.iteritems())
+        headers["Accept"] = accept
+        return tests.request("GET", path or self.path, headers=headers)
+
+    def permalink(self):
+        created_at = self.document.current_revision.created_at
+        return "%s/%s.%d" % (self.path,
+                             created_at.strftime("%Y/%m/%d/%H%M%S"),
+                             created_at.microsecond)
+
+    def test_text_etag(self):
+        status, headers, body = self.get("text/plain")
+        self.assertEqual(status, 200)
+        self.assertEqual(body, "# Hello\n\nWorld.")
+        self.assertTrue("Last-Modified" in headers)
+        status, headers, body = self.get("text/plain",
+                                         If_None_Match=headers["ETag"])
+        self.assertEqual(status, 304)
+        self.assertEqual(body, "")
+
+    def test_text_if_modified_since(self):
+        status, headers, body = self.get("text/plain")
+        modified_at = headers["Last-Modified"]
+        status, headers, body = self.get("text/plain",
+                                         If_Modified_Since=modified_at)
+        self.assertEqual(status, 304)
+        status, headers, body = self.get(
+            "text/plain", If_Modified_Since="Mon, 01 Jan 1990 00:00:00 GMT"
+        )
+        self.assertEqual(status, 200)
+
+    def test_text_modified(self):
+        status, headers, body = self.get("text/plain")
+        self.document.body = u"Changed."
+        status, headers, body = self.get("text/plain",
+                                         If_None_Match=headers["ETag"])
+        self.assertEqual(status, 200)
+        self.assertEqual(body, "Changed.")
+
+    def test_permalink(self):
+        path = self.permalink()
+        status, headers, body = self.get("text/plain", path)
+        self.assertEqual(status, 200)
+        self.assertEqual(headers["Cache-Control"], "public, max-age=31536000")
+        self.document.body = u"Changed."
+        status, headers, body = self.get("text/plain", path,
+                                         If_None_Match=headers["ETag"])
+        self.assertEqual(status, 304)
+
+    def test_html_etag_only(self):
+        status, headers, body = self.get("text/html")
+        self.assertEqual(status, 200)
+        self.assertFalse("Last-Modified" in headers)
+        etag = headers["ETag"]
+        status, headers, body = self.get("text/html", If_None_Match=etag)
+        self.assertEqual(status, 304)
+        status, headers, body = self.get(
+            "text/html", If_Modified_Since="Fri, 01 Jan 2100 00:00:00 GMT"
+        )
+        self.assertEqual(status, 200)
+
+    def test_html_fork_edited(self):
+        status, headers, body = self.get("text/html")
+        fork = self.document.fork(None, u"Forked.")
+        fork.put()
+        fork.body = u"# Retitled fork"
+        status, headers, body = self.get("text/html",
+                                         If_None_Match=headers["ETag"])
+        self.assertEqual(status, 200)
+        self.assertTrue("Retitled fork" in body)
+
+
+class MethodHandler(webapp.RequestHandler):
+
+    def respond(self):
+        self.response.headers["Content-Type"] = "text/plain"
+        self.response.out.write("%s %s %s" % (self.request.method,
+                                              self.request.pseudo_method,
+                                              self.request.get("field")))
+
+    get = post = put = delete = respond
+
+
+class RequestBodyTest(unittest.TestCase):
+
+    MAX_BODY_SIZE = 16
+
+    def setUp(self):
+        self.application = WSGIApplication([("/", MethodHandler)],
+                                           max_body_size=self.MAX_BODY_SIZE)
+
+    def request(self, method, body="", **headers):
+        headers = dict((name.replace("_", "-"), value)
+                       for name, value in headers.iteritems())
+        return tests.request(method, "/", body, headers, self.application)
+
+    def test_too_large(self):
+        status, headers, body = self.request("POST", "x" * 17)
+        self.assertEqual(status, 413)
+        status, headers, body = self.request("POST", "x" * 16)
+        self.assertEqual(status, 200)
+
+    def test_unlimited(self):
+        self.application.max_body_size = None
+        status, headers, body = self.request("POST", "x" * 1024)
+        self.assertEqual(status, 200)
+
+    def test_override_header(self):
+        status, headers, body = self.request("POST",
+                                             X_HTTP_Method_Override="put")
+        self.assertEqual(body, "POST PUT ")
+
+    def test_override_field(self):
+        status, headers, body = self.request("POST",
+                                             "__method__=delete&field=1")
+        self.assertEqual(body, "POST DELETE 1")
+
+    def test_header_over_field(self):
+        status, headers, body = self.request("POST", "__method__=delete",
+                                             X_HTTP_Method_Override="put")
+        self.assertEqual(body, "POST PUT ")
+
+    def test_field_of_other_content_type(self):
+        status, headers, body = self.request("POST", "__method__=delete",
+                                             Content_Type="text/plain")
+        self.assertEqual(body, "POST POST ")
+
+    def test_no_override_of_get(self):
+        status, headers, body = self.request("GET",
+                                             X_HTTP_Method_Override="delete")
+        self.assertEqual(body, "GET GET ")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import random
+import unittest
+import tests  # sets up the API stubs and VLAAH before pastedown
+from google.appengine.api import memcache
+import pastedown.delta
+import pastedown.model
+from pastedown.model import Document, Revision
+
+
+SAMPLES = [
+    (u"", u""),
+    (u"", u"new\n"),
+    (u"old\n", u""),
+    (u"a\nb\nc\n", u"a\nB\nc\n"),
+    (u"a\nb\nc", u"a\nb\nc\nd"),
+    (u"a\nb\nc\n", u"start\na\nb\nc\n"),
+    (u"no newline", u"no newline\n"),
+    (u"crlf\r\nlines\r\n", u"crlf\r\nchanged\r\n"),
+    (u"안녕\nこんにちは\n", u"안녕\n"),
+]
+
+
+def edit(rng, lines):
+    """Returns a copy of the lines with a few lines replaced, inserted and
+    removed at random.
+
+    """
+    lines = list(lines)
+    for i in xrange(rng.randint(0, 5)):
+        kind = rng.randrange(3)
+        position = rng.randint(0, len(lines))
+        if kind == 0 and position < len(lines):
+            lines[position] = u"changed %d\n" % rng.randrange(100)
+        elif kind == 1:
+            lines.insert(position, u"inserted %d\n" % rng.randrange(100))
+        elif lines:
+            del lines[min(position, len(lines) - 1)]
+    return lines
+
+
+class DeltaTest(unittest.TestCase):
+
+    RANDOM_EDITS = 500
+
+    def assertPatches(self, old, new):
+        delta = pastedown.delta.diff(old, new)
+        self.assertEqual(pastedown.delta.patch(old, delta), new,
+                         repr((old, new)))
+
+    def test_samples(self):
+        for old, new in SAMPLES:
+            self.assertPatches(old, new)
+            self.assertPatches(new, old)
+
+    def test_random_edits(self):
+        rng = random.Random(0)
+        lines = [u"line %d\n" % i for i in xrange(30)]
+        for i in xrange(self.RANDOM_EDITS):
+            edited = edit(rng, lines)
+            self.assertPatches(u"".join(lines), u"".join(edited))
+            lines = edited
+
+    def test_same(self):
+        self.assertEqual(pastedown.delta.diff(u"a\nb\n", u"a\nb\n"), "[]")
+
+
+class RevisionChainTest(unittest.TestCase):
+
+    INTERVAL = 4
+
+    def setUp(self):
+        tests.clear()
+        self.storage = dict(pastedown.model.REVISION_STORAGE)
+        pastedown.model.REVISION_STORAGE.update(
+            deltas=True, snapshot_interval=self.INTERVAL
+        )
+
+    def tearDown(self):
+        pastedown.model.REVISION_STORAGE.update(self.storage)
+
+    def write(self, count):
+        lines = [u"Line %d.\n" % i for i in xrange(50)]
+        bodies = [u"".join(lines)]
+        document = Document(author=None, body=bodies[0])
+        document.put()
+        for i in xrange(1, count):
+            lines[i % len(lines)] = u"Edit %d.\n" % i
+            bodies.append(u"".join(lines))
+            document.body = bodies[-1]
+        revisions = Revision.all().filter("document =", document) \
+                                  .order("created_at").fetch(count)
+        return document, bodies, revisions
+
+    def test_chains(self):
+        document, bodies, revisions = self.write(10)
+        self.assertEqual([len(revision.chain) for revision in revisions],
+                         [0, 1, 2, 3, 0, 1, 2, 3, 0, 1])
+        for revision in revisions:
+            self.assertEqual(revision.delta is None, not revision.chain)
+            self.assertEqual(revision.stored_body, None)
+
+    def test_bodies(self):
+        document, bodies, revisions = self.write(10)
+        memcache.flush_all()
+        pastedown.model.BODY_CACHE.local.clear()
+        revisions = Revision.get([revision.key() for revision in revisions])
+        self.assertEqual([revision.body for revision in revisions], bodies)
+
+    def test_snapshot_when_delta_is_larger(self):
+        document, bodies, revisions = self.write(2)
+        document.body = u"Nothing in common."
+        revision = document.current_revision
+        self.assertEqual(revision.delta, None)
+        self.assertEqual(revision.chain, [])
+        self.assertEqual(revision.body, u"Nothing in common.")
+
+
+if __name__ == "__main__":
+    unittest.main()
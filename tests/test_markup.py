@@ -0,0 +1,95 @@
+import random
+import unittest
+import tests  # sets up the API stubs and VLAAH before pastedown
+from pastedown.model import MARKDOWN, create_title, extract_title, \
+                            render_html
+
+
+SAMPLES = [
+    u"",
+    u"Hello world",
+    u"Hello world. And the rest.",
+    u"Is it a question? Yes.",
+    u"Version 2.Twenty is not the end of a sentence.",
+    u"# Title\n\nBody.",
+    u"Title\n=====\n\nBody.",
+    u"Subtitle\n--------\n\n# Title",
+    u"Intro.\n\n# Title later",
+    u"    # not a heading\n\nText after code.",
+    u"- # heading in a list\n- item",
+    u"> # heading in a quote",
+    u"1. first\n2. second\n\n   continued\n\nafter",
+    u"A [link][1] first.\n\n  [1]: http://example.com/ \"Example\"",
+    u"*Emphasis* and **strong** and `code`. Then more.",
+    u"&amp; entities &lt; are &gt; decoded.",
+    u"A line that is much longer than the maximum title length without end",
+    u"Short\n\nparagraphs\n\nthat\n\ncontinue\n\nwithout\n\nany\n\nperiod",
+    u"Footnote[^1] first.\n\n[^1]: The note.",
+    u"<div>\n\nraw html\n\n</div>\n\nText.",
+    u"Text\r\nwith\r\n\r\nCRLF line endings.",
+    u"\t\n  \nLeading blank lines. Then text.",
+]
+WORDS = u"alpha beta gamma delta title Sentence code link end".split()
+
+
+def generate(rng):
+    """Generates a random Markdown document that mixes the constructs
+    pastedown.markup splits and hints at.
+
+    """
+    def words(n):
+        text = u" ".join(rng.choice(WORDS) for i in xrange(n))
+        if rng.random() < 0.3:
+            text = text.replace(u" ", rng.choice([u". ", u"? ", u" *"]), 1)
+        return text
+    parts = []
+    for i in xrange(rng.randint(1, 8)):
+        kind = rng.randrange(10)
+        if kind == 0:
+            part = u"# " + words(3)
+        elif kind == 1:
+            part = words(3) + u"\n" + rng.choice([u"=", u"-"]) * 5
+        elif kind == 2:
+            part = u"\n".join(rng.choice([u"- ", u"* ", u"1. "]) + words(3)
+                              for j in xrange(3))
+        elif kind == 3:
+            part = u"> " + words(4)
+        elif kind == 4:
+            part = u"    " + words(4)
+        elif kind == 5:
+            part = u"See [%s][%d]." % (words(1), i)
+            parts.append(u"  [%d]: http://example.com/%d" % (i, i))
+        elif kind == 6:
+            part = u"- item\n\n  # " + words(2)
+        else:
+            part = words(rng.randint(1, 12))
+        parts.append(part)
+    return u"\n\n".join(parts)
+
+
+class ConformanceTest(unittest.TestCase):
+    """extract_title() and render_html() must agree with rendering the
+    whole document by MARKDOWN.convert().
+
+    """
+
+    RANDOM_DOCUMENTS = 1000
+
+    def documents(self):
+        rng = random.Random(0)
+        return SAMPLES + [generate(rng)
+                          for i in xrange(self.RANDOM_DOCUMENTS)]
+
+    def test_extract_title(self):
+        for body in self.documents():
+            expected = create_title(MARKDOWN.convert(body))
+            self.assertEqual(extract_title(body), expected, repr(body))
+
+    def test_render_html(self):
+        for body in self.documents():
+            expected = unicode(MARKDOWN.convert(body))
+            self.assertEqual(render_html(body), expected, repr(body))
+
+
+if __name__ == "__main__":
+    unittest.main()
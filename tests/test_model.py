@@ -0,0 +1,176 @@
+import unittest
+import tests  # sets up the API stubs and VLAAH before pastedown
+from google.appengine.ext import db
+from pastedown.model import Content, DeletedDocumentError, Document, \
+                            RecentDocuments, Revision
+
+
+class DocumentTest(unittest.TestCase):
+
+    def setUp(self):
+        tests.clear()
+        self.author = tests.VLAAH.find("~tester")
+
+    def test_authored_key_name(self):
+        doc = Document(author=self.author, body=u"# Hello, World!\n\nBody.")
+        doc.put()
+        self.assertEqual(doc.key().name(), "~tester/hello-world")
+        self.assertEqual(doc.title, u"Hello, World!")
+        self.assertEqual(doc.body, u"# Hello, World!\n\nBody.")
+
+    def test_authored_key_name_collision(self):
+        first = Document(author=self.author, body=u"# Same")
+        first.put()
+        second = Document(author=self.author, body=u"# Same")
+        second.put()
+        self.assertEqual(first.key().name(), "~tester/same")
+        self.assertTrue(second.key().name().startswith("~tester/same-"))
+
+    def test_anonymous_key_name(self):
+        doc = Document(author=None, body=u"# Anonymous")
+        doc.put()
+        self.assertTrue("/" not in doc.key().name())
+
+    def test_fork(self):
+        doc = Document(author=None, body=u"Original.")
+        doc.put()
+        fork = doc.fork(self.author, u"# Forked\n\nOriginal.")
+        fork.put()
+        self.assertEqual(fork.key().name(), "~tester/forked")
+        self.assertEqual(fork.parent_document.key(), doc.key())
+        self.assertEqual(fork.revision_count, 2)
+        self.assertEqual(doc.fork_count, 1)
+
+    def test_fork_lineage(self):
+        doc = Document(author=None, body=u"First.")
+        doc.put()
+        doc.body = u"Second."
+        fork = doc.fork(self.author, u"Forked.")
+        fork.put()
+        self.assertFalse(fork.lineage_indexed)
+        self.assertEqual(fork.revision_count, 3)
+        tests.run_tasks()
+        fork = Document.get(fork.key())
+        self.assertTrue(fork.lineage_indexed)
+        self.assertTrue(fork.counted)
+        self.assertEqual(fork.inherited_revisions, 2)
+        self.assertEqual(fork.revision_count, 3)
+        inherited = Revision.all().filter("lineage =", fork).count()
+        self.assertEqual(inherited, 3)
+        self.assertEqual([unicode(rev) for rev in fork.revisions],
+                         [u"Forked.", u"Second.", u"First."])
+        tests.run_tasks()
+        self.assertEqual(Revision.all().filter("lineage =", fork).count(), 3)
+
+
+class PurgeTest(unittest.TestCase):
+
+    def setUp(self):
+        tests.clear()
+        self.batch_size = Document.PURGE_BATCH_SIZE
+        Document.PURGE_BATCH_SIZE = 2
+        self.document = Document(author=None, body=u"Revision 0.")
+        self.document.put()
+        for i in xrange(1, 5):
+            self.document.body = u"Revision %d." % i
+        self.forks = []
+        for i in xrange(3):
+            fork = self.document.fork(None, u"Fork %d." % i)
+            fork.put()
+            self.forks.append(fork.key())
+        tests.run_tasks()
+
+    def tearDown(self):
+        Document.PURGE_BATCH_SIZE = self.batch_size
+
+    def test_hidden_at_once(self):
+        key = self.document.key()
+        self.document.delete()
+        document = Document.get(key)
+        self.assertTrue(document.deleted)
+        self.assertEqual(document.updated_at, None)
+
+    def test_purge_resumes(self):
+        key = self.document.key()
+        self.document.delete()
+        self.assertTrue(tests.run_tasks() > 3)
+        self.assertEqual(Document.get(key), None)
+        self.assertEqual(Revision.all().filter("document =", key).count(), 0)
+        for fork in Document.get(self.forks):
+            self.assertEqual(fork.parent_document, None)
+            self.assertEqual(fork.inherited_revisions, 0)
+            self.assertEqual(fork.revision_count, 1)
+            self.assertEqual([unicode(rev) for rev in fork.revisions],
+                             [fork.body])
+
+    def test_refuse_revision(self):
+        stale = Document.get(self.document.key())
+        self.document.delete()
+        self.assertRaises(DeletedDocumentError, setattr, stale, "body",
+                          u"Raced edit.")
+        self.assertEqual(Document.get(self.document.key()).updated_at, None)
+
+    def test_recent_tombstone(self):
+        key_name = self.document.key().name()
+        entry = RecentDocuments.make_entry(self.document)
+        self.assertTrue(key_name in [entry["key_name"] for entry
+                                     in RecentDocuments.get_entries()])
+        self.document.delete()
+        RecentDocuments.update([entry])
+        self.assertFalse(key_name in [entry["key_name"] for entry
+                                      in RecentDocuments.get_entries()])
+
+
+class ContentTest(unittest.TestCase):
+
+    def setUp(self):
+        tests.clear()
+
+    def references(self, text):
+        content = Content.get_by_key_name(Content.create_digest(text))
+        return content and content.references
+
+    def test_shared(self):
+        first = Document(author=None, body=u"Same body.")
+        first.put()
+        second = Document(author=None, body=u"Same body.")
+        second.put()
+        self.assertEqual(self.references(u"Same body."), 2)
+        revision = first.current_revision
+        self.assertEqual(revision.stored_body, None)
+        self.assertEqual(revision.digest, Content.create_digest(u"Same body."))
+        self.assertEqual(Revision.get(revision.key()).body, u"Same body.")
+
+    def test_released_on_purge(self):
+        first = Document(author=None, body=u"Same body.")
+        first.put()
+        first.body = u"Own body."
+        second = Document(author=None, body=u"Same body.")
+        second.put()
+        first.delete()
+        tests.run_tasks()
+        self.assertEqual(self.references(u"Same body."), 1)
+        self.assertEqual(self.references(u"Own body."), None)
+        second.delete()
+        tests.run_tasks()
+        self.assertEqual(self.references(u"Same body."), None)
+
+    def test_inline_on_contention(self):
+        acquire = Content.__dict__["acquire"]
+        def contended(cls, text):
+            raise db.TransactionFailedError()
+        Content.acquire = classmethod(contended)
+        try:
+            document = Document(author=None, body=u"Contended body.")
+            document.put()
+        finally:
+            Content.acquire = acquire
+        revision = Revision.get(document.current_revision.key())
+        self.assertEqual(revision.digest, None)
+        self.assertEqual(revision.stored_body, u"Contended body.")
+        self.assertEqual(revision.body, u"Contended body.")
+        self.assertEqual(self.references(u"Contended body."), None)
+
+
+if __name__ == "__main__":
+    unittest.main()
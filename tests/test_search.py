@@ -0,0 +1,108 @@
+import unittest
+import tests  # sets up the API stubs and VLAAH before pastedown
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import db
+import pastedown.search
+from pastedown.search import IndexState, PostingBlock, PostingList
+from pastedown.model import Document
+
+
+class SearchTest(unittest.TestCase):
+
+    def setUp(self):
+        tests.clear()
+        self.settings = pastedown.search.SHARDS, pastedown.search.BLOCK_SIZE
+        pastedown.search.SHARDS = 1
+        pastedown.search.BLOCK_SIZE = 4
+
+    def tearDown(self):
+        pastedown.search.SHARDS, pastedown.search.BLOCK_SIZE = self.settings
+
+    def update(self, key_names, frequency):
+        for key_name in key_names:
+            db.run_in_transaction(PostingList.update, u"alpha", key_name,
+                                  frequency)
+
+    def postings(self):
+        return PostingList.get_by_key_name(PostingList.key_name(u"alpha", 0))
+
+    def test_split(self):
+        key_names = [u"doc%02d" % i for i in xrange(20)]
+        self.update(reversed(key_names), 1)
+        postings = self.postings()
+        self.assertEqual(postings.bounds, sorted(postings.bounds))
+        self.assertEqual(postings.document_count, 20)
+        blocks = db.get([postings.block_key(i)
+                         for i in xrange(len(postings.bounds))])
+        self.assertTrue(len(blocks) > 1)
+        documents = []
+        for size, block in zip(postings.sizes, blocks):
+            self.assertEqual(len(block.documents), size)
+            self.assertTrue(size <= pastedown.search.BLOCK_SIZE)
+            documents.extend(block.documents)
+        self.assertEqual(documents, key_names)
+
+    def test_remove(self):
+        key_names = [u"doc%02d" % i for i in xrange(20)]
+        self.update(key_names, 1)
+        self.update(key_names[:10], 0)
+        postings = self.postings()
+        self.assertEqual(postings.document_count, 10)
+        self.update(key_names[10:], 0)
+        self.assertEqual(self.postings(), None)
+        self.assertEqual(PostingBlock.all().count(), 0)
+
+    def test_search(self):
+        bodies = [u"alpha beta", u"alpha alpha beta", u"alpha gamma",
+                  u"beta gamma"] + [u"alpha filler %d" % i for i in xrange(10)]
+        keys = []
+        for body in bodies:
+            document = Document(author=None, body=body)
+            document.put()
+            keys.append(document.key().name())
+        tests.run_tasks()
+        self.assertEqual(pastedown.search.search(u"alpha beta"),
+                         [keys[1], keys[0]])
+        self.assertEqual(set(pastedown.search.search(u"gamma")),
+                         set([keys[2], keys[3]]))
+        self.assertEqual(pastedown.search.search(u"delta"), [])
+
+    def test_reindex_and_remove(self):
+        document = Document(author=None, body=u"alpha beta")
+        document.put()
+        key_name = document.key().name()
+        tests.run_tasks()
+        document.body = u"alpha gamma"
+        tests.run_tasks()
+        self.assertEqual(pastedown.search.search(u"beta"), [])
+        self.assertEqual(pastedown.search.search(u"gamma"), [key_name])
+        document.delete()
+        tests.run_tasks()
+        self.assertEqual(pastedown.search.search(u"alpha"), [])
+        self.assertEqual(IndexState.get_by_key_name(key_name), None)
+
+    def test_lease(self):
+        document = Document(author=None, body=u"alpha beta")
+        document.put()
+        key_name = document.key().name()
+        stub = apiproxy_stub_map.apiproxy.GetStub("taskqueue")
+        stub.FlushQueue("default")
+        self.assertNotEqual(
+            db.run_in_transaction(IndexState.acquire, key_name, "other"), None
+        )
+        self.assertEqual(
+            db.run_in_transaction(IndexState.acquire, key_name, "another"), None
+        )
+        pastedown.search.index_document(key_name)
+        self.assertEqual(pastedown.search.search(u"alpha"), [])
+        self.assertEqual(len(stub.GetTasks("default")), 1)
+        db.run_in_transaction(IndexState.release, key_name, "other", {})
+        self.assertFalse(
+            db.run_in_transaction(IndexState.release, key_name, "other", {})
+        )
+        tests.run_tasks()
+        self.assertEqual(pastedown.search.search(u"alpha"), [key_name])
+
+
+if __name__ == "__main__":
+    unittest.main()
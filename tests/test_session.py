@@ -0,0 +1,99 @@
+import time
+import base64
+import unittest
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+import tests  # sets up the API stubs and VLAAH before pastedown
+from google.appengine.api import memcache
+from pastedown.session import CookieStore, SessionMiddleware
+from pastedown.model import find_session_epoch, bump_session_epoch
+
+
+class CookieStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = CookieStore("secret")
+
+    def test_round_trip(self):
+        data = {"person_name": "~tester", "ticket_id": "abc", "epoch": 1}
+        value = self.store.save(None, data)
+        self.assertEqual(self.store.load(value), data)
+
+    def test_tampered_payload(self):
+        value = self.store.save(None, {"person_name": "~tester"})
+        payload, signature = value.split(".")
+        forged = base64.urlsafe_b64encode(
+            base64.urlsafe_b64decode(payload).replace("~tester", "~victim")
+        )
+        self.assertEqual(self.store.load(forged + "." + signature), {})
+
+    def test_tampered_signature(self):
+        value = self.store.save(None, {"person_name": "~tester"})
+        last = "0" if value[-1] != "0" else "1"
+        self.assertEqual(self.store.load(value[:-1] + last), {})
+
+    def test_other_secret(self):
+        value = CookieStore("other").save(None, {"person_name": "~tester"})
+        self.assertEqual(self.store.load(value), {})
+
+    def test_expired(self):
+        signed_at = int(time.time()) - CookieStore.MAX_AGE - 1
+        payload = json.dumps({"data": {"person_name": "~tester"},
+                              "time": signed_at})
+        payload = base64.urlsafe_b64encode(payload)
+        value = "%s.%s" % (payload, self.store.sign(payload))
+        self.assertEqual(self.store.load(value), {})
+
+    def test_malformed(self):
+        for value in "", ".", "garbage", "a.b.c":
+            self.assertEqual(self.store.load(value), {})
+        payload = base64.urlsafe_b64encode("[1, 2]")
+        value = "%s.%s" % (payload, self.store.sign(payload))
+        self.assertEqual(self.store.load(value), {})
+
+
+class SessionMiddlewareTest(unittest.TestCase):
+
+    def request(self, secure, cookie=""):
+        def application(environ, start_response):
+            environ["pastedown.session"]["person_name"] = "~tester"
+            start_response("200 OK", [])
+            return [""]
+        middleware = SessionMiddleware(application, "secret", secure=secure)
+        headers = []
+        def start_response(status, response_headers, exc_info=None):
+            headers.extend(response_headers)
+        middleware({"HTTP_COOKIE": cookie}, start_response)
+        return dict(headers).get("Set-Cookie")
+
+    def test_secure(self):
+        cookie = self.request(secure=True)
+        self.assertTrue(cookie.startswith("pastedown_session="))
+        self.assertTrue("; HttpOnly" in cookie)
+        self.assertTrue("; Secure" in cookie)
+
+    def test_insecure(self):
+        self.assertFalse("Secure" in self.request(secure=False))
+
+
+class SessionEpochTest(unittest.TestCase):
+
+    def setUp(self):
+        tests.clear()
+
+    def test_bump(self):
+        self.assertEqual(find_session_epoch("~tester"), 0)
+        self.assertEqual(bump_session_epoch("~tester"), 1)
+        self.assertEqual(find_session_epoch("~tester"), 1)
+        self.assertEqual(find_session_epoch("~other"), 0)
+
+    def test_bump_survives_memcache(self):
+        bump_session_epoch("~tester")
+        memcache.flush_all()
+        self.assertEqual(find_session_epoch("~tester"), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()